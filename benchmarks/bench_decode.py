@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Microbenchmark della decodifica delle risposte di train_info e timetable.
+Confronta l'implementazione attuale con quella originale (riportata qui
+sotto) e verifica che i risultati siano identici.
+
+Uso: python benchmarks/bench_decode.py [--stops 30] [--trains 100]
+'''
+
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from trenitalia import TrenitaliaBackend  # noqa: E402
+
+
+NIL = {"nil": True}
+
+
+class Decoder(TrenitaliaBackend):
+    '''Backend che non apre alcuna connessione: serve solo a richiamare
+    i metodi di parsing
+    '''
+
+    def __init__(self):
+        self._device_id = "benchmark"
+
+
+class ReferenceDecoder(Decoder):
+    '''Implementazione originale della decodifica, usata come riferimento
+    per il confronto
+    '''
+
+    def _decode(self, response):
+        return json.loads(self._cleanup(response))
+
+    def _parse_time(self, string):
+        values = re.findall(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", string)[0]
+        total_seconds = 0
+        if values[0] != "":
+            total_seconds += int(values[0]) * 3600
+        if values[1] != "":
+            total_seconds += int(values[1]) * 60
+        if values[2] != "":
+            total_seconds += int(values[2])
+        return timedelta(seconds=total_seconds)
+
+    def _parse_date(self, string, timezone=True):
+        if timezone:
+            return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S%z")
+        return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S")
+
+    def _parse_stop_type(self, string):
+        convert = {"Transit": "T",
+                   "Departure": "P",
+                   "Arrival": "A",
+                   "Stop": "F"}
+        return convert[string]
+
+
+def wrap(obj):
+    return "/*-secure-\n" + json.dumps(obj) + "*/"
+
+
+def train_response(stops):
+    def stop(i):
+        reached = i < stops // 3
+        hh, mm = 6 + i // 6, (i * 10) % 60
+        sched = "2018-09-24T{:02d}:{:02d}:00+02:00".format(hh, mm)
+        actual = "2018-09-24T{:02d}:{:02d}:00+02:00".format(hh, mm + 5)
+        return {"Reached": reached,
+                "StopType": ("Departure" if i == 0 else "Arrival"
+                             if i == stops - 1 else "Stop"),
+                "Station": {"Id": "8300{:05d}".format(i),
+                            "Latitude": "45.{:04d}".format(i),
+                            "Longitude": "9.{:04d}".format(i),
+                            "Name": "STAZIONE {}".format(i)},
+                "ScheduledInfo": {"Departure": sched if i < stops - 1
+                                  else NIL,
+                                  "Arrival": sched if i else NIL},
+                "ActualInfo": {"Departure": actual if reached else NIL,
+                               "Arrival": actual if reached and i else NIL,
+                               "Track": str(i % 12 + 1) if reached else ""}}
+    data = {"Train": {"CategoryCode": "IC", "CategoryName": "Intercity",
+                      "Number": "35"},
+            "ScheduledDuration": "PT7H12M",
+            "Delay": "PT5M",
+            "IsViaggiaTreno": True,
+            "LastCheckPointTime": "2018-09-24T08:05:00",
+            "LastReachedCheckPoint": "STAZIONE 3",
+            "Stops": {"RealtimeTrainStop": [stop(i) for i in range(stops)]}}
+    return wrap({"statusCode": 200,
+                 "Envelope": {"Body": {"TrainRealtimeInfoResponse": {
+                     "Body": {"RealtimeTrainInfoWithStops": data}}}}})
+
+
+def timetable_response(trains):
+    def train(i):
+        return {"LastReachedCheckPointBase":
+                    None if i % 3 else "2018-09-24T10:00:00+02:00",
+                "category": {"code": "REG", "name": "Regionale"},
+                "number": str(2000 + i),
+                "delay": "PT{}M".format(i % 15),
+                "originId": "830001700",
+                "originName": "MILANO CENTRALE",
+                "destinationId": "830000{:03d}".format(i % 50),
+                "destinationName": "DESTINAZIONE {}".format(i % 50),
+                "departureTime": "{:02d}:{:02d}".format(6 + i // 6,
+                                                       (i * 10) % 60),
+                "arrivalTime": "",
+                "scheduledTrack": str(i % 20 + 1),
+                "actualTrack": "" if i % 4 else str(i % 20 + 1)}
+    return wrap({"trains": [train(i) for i in range(trains)]})
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stops", type=int, default=30)
+    parser.add_argument("--trains", type=int, default=100)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    train = train_response(args.stops)
+    board = timetable_response(args.trains)
+    cases = [("train_info", args.stops, "stop",
+              lambda d: d._parse_train_info(d._decode(train))),
+             ("timetable", args.trains, "train",
+              lambda d: d._parse_timetable(d._decode(board)))]
+
+    new, ref = Decoder(), ReferenceDecoder()
+    print("JSON backend: {}".format(
+        "orjson" if sys.modules.get("orjson") else "json"))
+    for name, items, unit, func in cases:
+        if func(new) != func(ref):
+            sys.exit("{}: output differs from the reference".format(name))
+        t_ref = measure(lambda: func(ref), args.number)
+        t_new = measure(lambda: func(new), args.number)
+        print("{:<11} reference {:8.2f} us/{unit}   current {:8.2f} us/{unit}"
+              "   speedup {:.1f}x".format(name, t_ref / items * 1e6,
+                                          t_new / items * 1e6,
+                                          t_ref / t_new, unit=unit))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark dei metodi di TrenitaliaBackend contro il server locale di
+stub_server.py, senza accesso alla rete.
+
+Per ogni metodo vengono misurati il throughput, i percentili della
+latenza, la memoria allocata per chiamata e il tempo di parsing della
+risposta. Con --save i risultati vengono salvati in formato JSON; con
+--baseline vengono confrontati con un'esecuzione precedente e lo script
+termina con un errore se il throughput o il tempo di parsing peggiorano
+oltre la soglia indicata da --max-regression.
+
+Uso: python benchmarks/run.py [--requests 200] [--concurrency 4]
+                              [--latency 0.0] [--save risultati.json]
+                              [--baseline risultati.json]
+'''
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from trenitalia import TrenitaliaBackend, _percentile  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+
+def methods(fixtures):
+    '''Per ogni metodo: la chiamata da misurare e una funzione che esegue
+    solo il parsing della risposta registrata
+    '''
+    solutions = fixtures["solutions"]["solutions"]
+    return {
+        "search_station": (
+            lambda tb: tb.search_station("milano"),
+            lambda tb: tb._parse_stations(fixtures["stations"])),
+        "search_solution": (
+            lambda tb: list(tb.search_solution("830001700", "830011119",
+                                               None, limit=10)),
+            lambda tb: [tb._parse_solution(s) for s in solutions]),
+        "train_info": (
+            lambda tb: tb.train_info("605"),
+            lambda tb: tb._parse_train_info(fixtures["train_info"])),
+        "timetable": (
+            lambda tb: tb.timetable("830001700", "departure"),
+            lambda tb: tb._parse_timetable(fixtures["timetable"])),
+    }
+
+
+def bench_method(tb, call, parse, requests, concurrency):
+    latencies = []
+    lock = threading.Lock()
+
+    def timed(_):
+        start = time.perf_counter()
+        call(tb)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    # Riscaldamento: autenticazione, connessioni e cache del parsing
+    for _ in range(3):
+        call(tb)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    total = time.perf_counter() - start
+    latencies.sort()
+
+    # Memoria massima allocata durante una chiamata
+    calls = 20
+    peak = 0
+    for _ in range(calls):
+        tracemalloc.start()
+        call(tb)
+        peak += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # Il tempo di parsing è il migliore su più ripetizioni, per renderlo
+    # confrontabile tra esecuzioni diverse
+    parse_time = min(timeit.repeat(lambda: parse(tb), number=50,
+                                   repeat=7)) / 50
+
+    return {"throughput": requests / total,
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p90_ms": _percentile(latencies, 90) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "peak_kb_per_call": peak / calls / 1024,
+            "parse_us": parse_time * 1e6}
+
+
+def compare(results, baseline, max_regression):
+    '''Restituisce la lista dei peggioramenti rispetto a baseline'''
+    failures = []
+    for name, current in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if current["throughput"] < old["throughput"] / (1 + max_regression):
+            failures.append("{}: throughput {:.1f}/s (baseline {:.1f}/s)"
+                            .format(name, current["throughput"],
+                                    old["throughput"]))
+        if current["parse_us"] > old["parse_us"] * (1 + max_regression):
+            failures.append("{}: parse {:.1f} us (baseline {:.1f} us)"
+                            .format(name, current["parse_us"],
+                                    old["parse_us"]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="latenza simulata del server, in secondi")
+    parser.add_argument("--compress", action="store_true",
+                        help="il server comprime le risposte con gzip")
+    parser.add_argument("--only", action="append",
+                        help="esegue solo il metodo indicato")
+    parser.add_argument("--save", help="salva i risultati in formato JSON")
+    parser.add_argument("--baseline", help="risultati con cui confrontare")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="peggioramento massimo tollerato (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = {}
+    with StubServer(latency=args.latency, compress=args.compress) as stub:
+        tb = stub.backend(TrenitaliaBackend, pool_size=args.concurrency)
+        for name, (call, parse) in methods(stub.fixtures).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = bench_method(tb, call, parse, args.requests,
+                                         args.concurrency)
+
+    print("{:<16}{:>10}{:>9}{:>9}{:>9}{:>12}{:>10}".format(
+        "method", "req/s", "p50 ms", "p90 ms", "p99 ms", "peak KB",
+        "parse us"))
+    for name, r in results.items():
+        print("{:<16}{:>10.1f}{:>9.2f}{:>9.2f}{:>9.2f}{:>12.1f}{:>10.1f}"
+              .format(name, r["throughput"], r["p50_ms"], r["p90_ms"],
+                      r["p99_ms"], r["peak_kb_per_call"], r["parse_us"]))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.max_regression)
+        if failures:
+            print("\nPerformance regressions:")
+            for failure in failures:
+                print("  " + failure)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
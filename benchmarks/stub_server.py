@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Server locale che riproduce il protocollo Worklight del backend di
+Trenitalia, per eseguire benchmark e prove senza accesso alla rete.
+
+Il server gestisce:
+* la challenge 401 su init (wl_antiXSRFRealm e wl_deviceNoProvisioningRealm)
+  e la risposta WL-Authentication-Success;
+* la scadenza delle sessioni (dopo session_ttl secondi o su richiesta);
+* gli errori temporanei del gateway (503 con probabilità error_rate);
+* la compressione gzip delle risposte, se compress è True e il client
+  la accetta;
+* i tag /*-secure- */ attorno a ogni risposta;
+* le procedure StationsAdapter/GetStations,
+  SearchAndBuyAdapter/SearchTravels (con paginazione),
+  TrainRealtimeInfoAdapter/TrainRealtimeInfo e
+  GetStationTimetables/getStationTables,
+  che restituiscono le risposte registrate nella cartella fixtures.
+
+Uso: python benchmarks/stub_server.py [--port 8080] [--latency 0.05]
+'''
+
+import argparse
+import gzip
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "fixtures")
+
+
+def load_fixtures(path=FIXTURES):
+    '''Carica le risposte registrate. solutions.json contiene l'elenco
+    completo delle soluzioni, che il server restituisce a pagine.
+    '''
+    fixtures = {}
+    for name in ("stations", "solutions", "train_info", "timetable"):
+        with open(os.path.join(path, name + ".json"), encoding="utf-8") as f:
+            fixtures[name] = json.load(f)
+    return fixtures
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Intestazioni e corpo vengono scritti separatamente: senza
+        # TCP_NODELAY ogni risposta subirebbe il ritardo dell'ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, body):
+        data = ("/*-secure-\n" + body + "*/").encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        if (self.server.stub.compress and
+                "gzip" in self.headers.get("Accept-Encoding", "")):
+            data = gzip.compress(data, compresslevel=5)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        if self.path.endswith("/init"):
+            self.send_header("Set-Cookie", "JSESSIONID={}; Path=/".format(
+                uuid.uuid4().hex))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _challenge(self):
+        stub = self.server.stub
+        iid = stub._new_challenge()
+        self._send(401, json.dumps({"challenges": {
+            "wl_antiXSRFRealm": {"WL-Instance-Id": iid},
+            "wl_deviceNoProvisioningRealm": {"token": uuid.uuid4().hex}}}))
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8")
+        if stub.latency:
+            time.sleep(stub.latency + random.uniform(0, stub.jitter))
+        if self.path.endswith("/init"):
+            stub._count("init")
+            if "Authorization" not in self.headers:
+                return self._challenge()
+            if not stub._authorize(self.headers.get("WL-Instance-Id"),
+                                   self.headers["Authorization"]):
+                return self._send(403, json.dumps({"errors": [
+                    "Authentication failed"]}))
+            return self._send(200, json.dumps(
+                {"WL-Authentication-Success": {
+                    "wl_deviceNoProvisioningRealm": {"userId": "device"}}}))
+        if not self.path.endswith("/query"):
+            return self._send(404, json.dumps({"errors": ["Not found"]}))
+        if stub.error_rate and random.random() < stub.error_rate:
+            stub._count("unavailable")
+            return self._send(503, json.dumps({"errors": [
+                "Service unavailable"]}))
+        if not stub._valid(self.headers.get("WL-Instance-Id")):
+            stub._count("expired")
+            return self._challenge()
+        form = parse_qs(body)
+        adapter = form["adapter"][0]
+        procedure = form["procedure"][0]
+        stub._count(adapter)
+        parameters = json.loads(form["parameters"][0])
+        handler = stub.procedures.get((adapter, procedure))
+        if handler is None:
+            return self._send(200, json.dumps({
+                "statusCode": 500,
+                "statusReason": "Procedura non disponibile"}))
+        self._send(200, handler(parameters))
+
+
+class StubServer():
+    '''Server Worklight locale. latency (più un ritardo casuale fino a
+    jitter) viene aggiunta a ogni risposta; le sessioni scadono dopo
+    session_ttl secondi (None = mai); una frazione error_rate delle query
+    riceve un errore 503; con compress=True le risposte vengono compresse
+    se il client lo richiede.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 session_ttl=None, fixtures=None, error_rate=0.0,
+                 compress=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.session_ttl = session_ttl
+        self.error_rate = error_rate
+        self.compress = compress
+        self.fixtures = fixtures or load_fixtures()
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._challenges = set()
+        self._sessions = {}
+        # Le risposte senza parametri vengono serializzate una volta sola
+        self._stations_body = json.dumps(self.fixtures["stations"])
+        self._train_body = json.dumps(self.fixtures["train_info"])
+        self._timetable_body = json.dumps(self.fixtures["timetable"])
+        self.procedures = {
+            ("StationsAdapter", "GetStations"): self._get_stations,
+            ("SearchAndBuyAdapter", "SearchTravels"): self._search_travels,
+            ("TrainRealtimeInfoAdapter", "TrainRealtimeInfo"):
+                self._train_info,
+            ("GetStationTimetables", "getStationTables"): self._timetable}
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def backend(self, cls, *args, **kwargs):
+        '''Crea un'istanza di cls (TrenitaliaBackend o una classe
+        compatibile) collegata a questo server
+        '''
+        base = self.url + cls.BACKEND_PATH
+        stub_cls = type(cls.__name__, (cls,), {"HOST": self.url,
+                                               "INIT_URL": base + "init",
+                                               "QUERY_URL": base + "query"})
+        return stub_cls(*args, **kwargs)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def expire_sessions(self):
+        '''Invalida tutte le sessioni: la richiesta successiva di ogni
+        client riceverà una nuova challenge
+        '''
+        with self._lock:
+            self._sessions.clear()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _new_challenge(self):
+        iid = str(uuid.uuid4())
+        with self._lock:
+            self._challenges.add(iid)
+        return iid
+
+    def _authorize(self, iid, authorization):
+        try:
+            auth = json.loads(authorization)
+            auth["wl_deviceNoProvisioningRealm"]["ID"]["device"]["id"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        with self._lock:
+            if iid not in self._challenges:
+                return False
+            self._challenges.discard(iid)
+            self._sessions[iid] = time.monotonic()
+        return True
+
+    def _valid(self, iid):
+        with self._lock:
+            started = self._sessions.get(iid)
+            if started is None:
+                return False
+            if (self.session_ttl is not None and
+                    time.monotonic() - started > self.session_ttl):
+                del self._sessions[iid]
+                return False
+            return True
+
+    def _get_stations(self, parameters):
+        return self._stations_body
+
+    def _search_travels(self, parameters):
+        paging = (parameters[1]["SearchTravelsRequest"]["Body"]
+                  ["PagingCriteria"])
+        solutions = self.fixtures["solutions"]["solutions"]
+        start, end = paging["StartIndex"], paging["EndIndex"]
+        page = solutions[start:end + 1]
+        if not page:
+            return json.dumps({"statusCode": 500,
+                               "statusReason": "Errore restituito dal "
+                                               "sistema centrale"})
+        return json.dumps({
+            "statusCode": 200, "statusReason": "OK",
+            "Envelope": {"Body": {"SearchTravelsResponse": {"Body": {
+                "PageResult": {"TravelSolution":
+                               page[0] if len(page) == 1 else page}}}}}})
+
+    def _train_info(self, parameters):
+        number = (parameters[1]["TrainRealtimeInfoRequest"]["Body"]
+                  ["Train"]["Number"])
+        if number == "0":
+            return json.dumps({"statusCode": 500,
+                               "statusReason": "Treno non valido"})
+        return self._train_body
+
+    def _timetable(self, parameters):
+        return self._timetable_body
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="ritardo di ogni risposta, in secondi")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="ritardo casuale aggiuntivo massimo")
+    parser.add_argument("--session-ttl", type=float, default=None,
+                        help="durata delle sessioni, in secondi")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="frazione delle query che ricevono un 503")
+    parser.add_argument("--compress", action="store_true",
+                        help="comprime le risposte con gzip")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    args = parser.parse_args()
+    stub = StubServer(args.host, args.port, args.latency, args.jitter,
+                      args.session_ttl, load_fixtures(args.fixtures),
+                      args.error_rate, args.compress)
+    print("Listening on {}".format(stub.url))
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
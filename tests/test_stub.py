@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Prove di base di trenitalia contro il server locale di
+benchmarks/stub_server.py, senza accesso alla rete.
+
+Uso: python -m pytest -q
+'''
+
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from trenitalia import (TrenitaliaBackend, AsyncTrenitaliaBackend,  # noqa
+                        DelayStore, MemoryCache, Metrics, RecordingTransport,
+                        ReplayTransport, RequestScheduler,
+                        RequestsTransport, SessionPool, StationCatalog,
+                        main)
+from stub_server import StubServer  # noqa: E402
+
+
+@pytest.fixture
+def stub():
+    with StubServer() as server:
+        yield server
+
+
+def test_auth_challenge_and_expiry(stub):
+    tb = stub.backend(TrenitaliaBackend)
+    # Challenge 401 e risposta con l'header Authorization
+    assert stub.counts["init"] == 2
+    assert tb.train_info("605")["number"] == "605"
+    stub.expire_sessions()
+    assert tb.train_info("605")["number"] == "605"
+    assert stub.counts["expired"] == 1
+    assert stub.counts["init"] == 3
+    tb.close()
+
+
+def test_pool_rejected_handshake(stub):
+    pool = SessionPool(2, factory=lambda **kw: stub.backend(
+        TrenitaliaBackend, **kw))
+    authorize = stub._authorize
+    # Il server rifiuta le nuove autenticazioni con un 403
+    stub._authorize = lambda iid, authorization: False
+    stub.expire_sessions()
+    for _ in range(4):
+        with pytest.raises(TrenitaliaBackend.AuthenticationError):
+            pool.train_info("605")
+    assert all(not s["healthy"] and s["errors"] >= 1 for s in pool.stats)
+    # Le sessioni vengono autenticate di nuovo in background
+    stub._authorize = authorize
+    deadline = time.monotonic() + 10
+    while (not all(s["healthy"] for s in pool.stats) and
+           time.monotonic() < deadline):
+        time.sleep(0.05)
+    assert all(s["healthy"] for s in pool.stats)
+    assert pool.train_info("605")["number"] == "605"
+    pool.close()
+
+
+def test_scheduler_token_bucket(stub):
+    scheduler = RequestScheduler(rates={"*": 50}, burst=5)
+    tb = stub.backend(TrenitaliaBackend, scheduler=scheduler)
+    start = time.monotonic()
+    threads = [threading.Thread(target=tb.timetable,
+                                args=("830001700", "departure"))
+               for _ in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # Dopo le prime burst richieste ne parte una ogni 1/50 di secondo
+    assert time.monotonic() - start >= (30 - 5) / 50 * 0.9
+    stats = scheduler.stats["GetStationTimetables"]
+    assert stats["requests"] == 30 and stats["queued"] == 0
+    tb.close()
+
+
+def test_scheduler_circuit(stub):
+    scheduler = RequestScheduler(backoff=0.01, max_retries=1,
+                                 failure_threshold=3, reset_timeout=0.3)
+    tb = stub.backend(TrenitaliaBackend, scheduler=scheduler)
+    stub.error_rate = 1.0
+
+    def state():
+        return scheduler.stats["TrainRealtimeInfoAdapter"]["state"]
+
+    # Due tentativi falliti: il circuito resta chiuso
+    with pytest.raises(TrenitaliaBackend.ServiceUnavailable):
+        tb.train_info("605")
+    assert state() == "closed"
+    # Al terzo errore consecutivo il circuito si apre
+    with pytest.raises(TrenitaliaBackend.CircuitOpen):
+        tb.train_info("605")
+    assert state() == "open"
+    count = stub.counts["unavailable"]
+    with pytest.raises(TrenitaliaBackend.CircuitOpen):
+        tb.train_info("605")
+    assert stub.counts["unavailable"] == count
+    # La richiesta di prova fallisce e il circuito si riapre
+    time.sleep(0.35)
+    with pytest.raises(TrenitaliaBackend.CircuitOpen):
+        tb.train_info("605")
+    assert state() == "open"
+    assert stub.counts["unavailable"] == count + 1
+    # La richiesta di prova riesce e il circuito si chiude
+    stub.error_rate = 0.0
+    time.sleep(0.35)
+    assert tb.train_info("605")["number"] == "605"
+    assert state() == "closed"
+    stats = scheduler.stats["TrainRealtimeInfoAdapter"]
+    assert stats["failures"] == 4 and stats["rejected"] == 3
+    tb.close()
+
+
+def test_scheduler_retries_transient_errors(stub):
+    stub.error_rate = 0.3
+    scheduler = RequestScheduler(backoff=0.001, max_retries=20,
+                                 failure_threshold=100)
+    tb = stub.backend(TrenitaliaBackend, scheduler=scheduler)
+    for _ in range(20):
+        assert tb.train_info("605")["number"] == "605"
+    stats = scheduler.stats["TrainRealtimeInfoAdapter"]
+    assert stats["retries"] == stats["failures"] == stub.counts.get(
+        "unavailable", 0)
+    # Gli errori del gateway non vengono scambiati per sessioni scadute
+    assert stub.counts["init"] == 2
+    tb.close()
+
+
+class _FailingHandshake(RequestsTransport):
+    '''Trasporto che risponde 503 alla prima richiesta con l'header
+    Authorization
+    '''
+    failures = 1
+
+    def post(self, url, data=None, headers=None):
+        if headers and "Authorization" in headers and self.failures:
+            self.failures -= 1
+            response = requests.models.Response()
+            response.status_code = 503
+            response._content = b""
+            return response
+        return super().post(url, data, headers)
+
+
+def test_handshake_unavailable_is_retried(stub):
+    scheduler = RequestScheduler(backoff=0.001)
+    tb = stub.backend(TrenitaliaBackend, scheduler=scheduler,
+                      transport=_FailingHandshake())
+    stats = scheduler.stats["init"]
+    assert stats["retries"] == 1 and stats["failures"] == 1
+    assert stats["state"] == "closed"
+    assert tb.train_info("605")["number"] == "605"
+    tb.close()
+
+
+def test_async_handshake_unavailable_is_retried(stub):
+    pytest.importorskip("aiohttp")
+    scheduler = RequestScheduler(backoff=0.001)
+
+    async def run():
+        tb = stub.backend(AsyncTrenitaliaBackend, scheduler=scheduler)
+        post = tb._post
+        failures = [1]
+
+        async def failing_post(url, data=None, headers=None):
+            if headers and "Authorization" in headers and failures[0]:
+                failures[0] -= 1
+                return 503, ""
+            return await post(url, data, headers)
+
+        tb._post = failing_post
+        async with tb:
+            return await tb.train_info("605")
+
+    assert asyncio.run(run())["number"] == "605"
+    stats = scheduler.stats["init"]
+    assert stats["retries"] == 1 and stats["failures"] == 1
+
+
+def _received_bytes(metrics):
+    return sum(v for (name, _), v in metrics.counters.items()
+               if name == "received_bytes")
+
+
+def test_metrics_wire_bytes():
+    received = {}
+    for compress in (False, True):
+        with StubServer(compress=compress) as server:
+            metrics = Metrics()
+            tb = server.backend(TrenitaliaBackend, metrics=metrics)
+            tb.search_station("roma")
+            tb.close()
+        received[compress] = _received_bytes(metrics)
+        phases = {k[2] for k in metrics.histograms}
+        assert phases == {"network", "charset", "decode", "build"}
+    assert 0 < received[True] < received[False]
+
+    pytest.importorskip("aiohttp")
+
+    async def run(server, metrics):
+        async with server.backend(AsyncTrenitaliaBackend,
+                                  metrics=metrics) as tb:
+            await tb.search_station("roma")
+
+    with StubServer(compress=True) as server:
+        metrics = Metrics()
+        asyncio.run(run(server, metrics))
+    assert _received_bytes(metrics) == received[True]
+    assert {k[2] for k in metrics.histograms} >= {"network", "charset",
+                                                  "decode"}
+
+
+def test_pagination(stub):
+    tb = stub.backend(TrenitaliaBackend)
+    solutions = list(tb.search_solution("1", "2", None, limit=7,
+                                        page_size=3))
+    assert len(solutions) == 7
+    assert stub.counts["SearchAndBuyAdapter"] == 3
+    # Il fixture contiene 10 soluzioni: l'ultima pagina è incompleta
+    solutions = list(tb.search_solution("1", "2", None, limit=20,
+                                        page_size=4, prefetch=True))
+    assert len(solutions) == 10
+    assert len({s["solution_id"] for s in solutions}) == 10
+    assert stub.counts["SearchAndBuyAdapter"] == 6
+    tb.close()
+
+
+def test_coalescing(stub):
+    stub.latency = 0.2
+    tb = stub.backend(TrenitaliaBackend, cache=MemoryCache())
+    barrier = threading.Barrier(8)
+    results = []
+
+    def search():
+        barrier.wait()
+        results.append(tb.search_station("milano"))
+
+    threads = [threading.Thread(target=search) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert stub.counts["StationsAdapter"] == 1
+    assert all(r == results[0] for r in results)
+    stats = tb.cache.stats
+    assert stats["misses"] + stats["hits"] == 8
+    assert stats["coalesced"] + stats["hits"] == 7
+    tb.close()
+
+
+def test_async_single_reauth(stub):
+    pytest.importorskip("aiohttp")
+
+    async def run():
+        async with stub.backend(AsyncTrenitaliaBackend) as tb:
+            await tb.train_info("605")
+            stub.expire_sessions()
+            infos = await asyncio.gather(*[tb.train_info("605")
+                                           for _ in range(20)])
+        return infos
+
+    infos = asyncio.run(run())
+    assert all(i["number"] == "605" for i in infos)
+    # Challenge e risposta iniziali, poi una sola risposta alla challenge
+    # ricevuta con il 401 anche se tutte le richieste sono scadute
+    assert stub.counts["expired"] >= 1
+    assert stub.counts["init"] == 3
+
+
+def test_station_catalog(stub, tmp_path):
+    path = str(tmp_path / "stations.gz")
+    tb = stub.backend(TrenitaliaBackend)
+    catalog = StationCatalog(path, backend=tb)
+    # Nessun risultato nel catalogo: la ricerca va al server
+    assert catalog.search("milano")[0]["name"].startswith("MILANO")
+    assert stub.counts["StationsAdapter"] == 1
+    # Le ricerche con risultati locali, anche meno di limit, no
+    assert catalog.search("milano c")[0]["name"] == "MILANO CENTRALE"
+    assert stub.counts["StationsAdapter"] == 1
+    # Un nome già cercato non viene richiesto di nuovo, neanche da un
+    # catalogo caricato dal file salvato
+    catalog.search("xyz")
+    assert stub.counts["StationsAdapter"] == 2
+    catalog = StationCatalog(path, backend=tb)
+    catalog.search("xyz")
+    assert stub.counts["StationsAdapter"] == 2
+    assert catalog.nearest(45.48, 9.2, n=0) == []
+    assert catalog.nearest(45.48, 9.2, n=1)[0][1]["id"] == 1700
+    tb.close()
+
+
+def test_cli_batch(stub, monkeypatch):
+    tb = stub.backend(TrenitaliaBackend, lazy=True)
+    queries = ['{"op": "train", "number": "605", "id": "a"}',
+               '{"op": "train", "number": "0", "id": "b"}',
+               '{"op": "board", "station_id": "830001700",'
+               ' "ttype": "departure"}',
+               '{bad']
+    out = io.StringIO()
+    monkeypatch.setattr(sys, "stdin", io.StringIO("\n".join(queries)))
+    monkeypatch.setattr(sys, "stdout", out)
+    assert main(["--workers", "2", "batch"], backend=tb) == 0
+    lines = {line["line"]: line for line in map(
+        json.loads, out.getvalue().splitlines())}
+    assert lines[1]["id"] == "a" and lines[1]["result"]["number"] == "605"
+    # L'id viene riportato anche per le query fallite
+    assert lines[2]["id"] == "b" and "TrainNotFound" in lines[2]["error"]
+    assert lines[3]["id"] is None and len(lines[3]["result"]) > 0
+    assert "id" not in lines[4] and "error" in lines[4]
+    tb.close()
+
+
+def test_replay_equivalence(stub, tmp_path):
+    path = str(tmp_path / "exchanges.ndjson")
+    tb = stub.backend(TrenitaliaBackend,
+                      transport=RecordingTransport(path))
+    live = [tb.search_station("milano"),
+            list(tb.search_solution("1", "2", None, limit=7)),
+            tb.train_info("605"),
+            tb.timetable("830001700", "departure")]
+    tb.close()
+    replay = TrenitaliaBackend(transport=ReplayTransport(path))
+    assert [replay.search_station("milano"),
+            list(replay.search_solution("1", "2", None, limit=7)),
+            replay.train_info("605"),
+            replay.timetable("830001700", "departure")] == live
+    with pytest.raises(ReplayTransport.MissingExchange):
+        replay.train_info("9")
+
+
+def test_delay_store_round_trip(stub, tmp_path):
+    path = str(tmp_path / "delays")
+    store = DelayStore(path)
+    tb = stub.backend(TrenitaliaBackend, recorder=store)
+    info = tb.train_info("605", lazy=True)
+    trains = tb.timetable("830001700", "departure")
+    stops = len(info["stops"])
+    assert len(store) == stops + len(trains)
+    assert store.append((0, 20180924, 1, 2, DelayStore.KIND_BOARD, 60, 0,
+                         0, 0, 0, 0))
+    # Un'osservazione identica alla precedente non viene salvata
+    assert not store.append((1, 20180924, 1, 2, DelayStore.KIND_BOARD, 60,
+                             0, 0, 0, 0, 0))
+    expected = {"stop": list(store.delays(train=605,
+                                          kind=DelayStore.KIND_STOP)),
+                "board": list(store.delays(kind=DelayStore.KIND_BOARD)),
+                "stats": store.delay_stats(station=2)}
+    store.close()
+    tb.close()
+    store = DelayStore(path)
+    assert len(store) == stops + len(trains) + 1
+    assert list(store.delays(train=605,
+                             kind=DelayStore.KIND_STOP)) == expected["stop"]
+    assert list(store.delays(kind=DelayStore.KIND_BOARD)) == expected["board"]
+    assert store.delay_stats(station=2) == expected["stats"]
+    assert store.delay_stats(station=2)["count"] == 1
+    store.close()
+
+
+def _board_row(observed, date, train, delay):
+    return (observed, date, train, 1, DelayStore.KIND_BOARD, delay, 0, 0, 0,
+            0, 0)
+
+
+def test_delay_store_ragged_tail(tmp_path):
+    path = str(tmp_path / "delays")
+    store = DelayStore(path)
+    for i in range(10):
+        store.append(_board_row(i, 20180924, i, 60))
+    store.flush()
+    # Una scrittura interrotta ha aggiunto una riga solo alla prima
+    # colonna
+    first = store._file(0, DelayStore.COLUMNS[0])
+    with open(first, "ab") as f:
+        f.write(b"\0" * 8)
+    sizes = [os.path.getsize(store._file(0, c)) for c in DelayStore.COLUMNS]
+    reader = DelayStore(path)
+    assert len(reader) == 10
+    # L'apertura non modifica i file
+    assert [os.path.getsize(store._file(0, c))
+            for c in DelayStore.COLUMNS] == sizes
+    # Lo scrittore sostituisce la riga incompleta
+    store.append(_board_row(10, 20180924, 10, 120))
+    store.close()
+    reader = DelayStore(path)
+    assert len(reader) == 11
+    assert list(reader.delays(train=10)) == [120]
+    assert reader.delay_stats()["count"] == 11
+
+
+def test_delay_store_recent_dates(tmp_path):
+    path = str(tmp_path / "delays")
+    store = DelayStore(path)
+    dates = [20180920 + i for i in range(5)]
+    for date in dates:
+        store.append(_board_row(0, date, 1, 60))
+    store.close()
+    store = DelayStore(path)
+    assert sorted(store._last) == dates[-DelayStore.RECENT_DATES:]
+    # Le osservazioni invariate delle date recenti non vengono ripetute
+    assert not store.append(_board_row(1, dates[-1], 1, 60))
+    assert store.append(_board_row(1, dates[-1], 1, 90))
+    store.close()
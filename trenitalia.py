@@ -37,23 +37,450 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 '''
 
 
+
 import requests
+import requests.adapters
 import uuid
 import json
 import time
 import re
+import sqlite3
+import sys
+import argparse
+import array
+import asyncio
+import bisect
+import difflib
+import functools
+import gzip
+import heapq
+import itertools
+import math
+import mmap
+import os
+import random
+import threading
+import unicodedata
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import (ThreadPoolExecutor, Future, wait,
+                                FIRST_COMPLETED)
 from datetime import datetime, timedelta
 from decimal import Decimal
+from http.cookies import SimpleCookie
+from urllib.parse import quote_plus, urlencode, urlsplit
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_DURATION_RE = re.compile(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?")
+_JSON_WS = re.compile(r"[ \t\n\r]*")
+_JSON_DECODER = json.JSONDecoder()
+_json_loads = orjson.loads if orjson is not None else json.loads
+# Coppie (codice, nome) delle categorie dei treni, condivise dai record
+_CATEGORIES = {}
+# Latenze conservate dalla modalità batch per il calcolo dei percentili
+_LATENCY_SAMPLE = 10000
+_UUID_RE = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+# Il corpo delle chiamate alle procedure viene serializzato direttamente
+_FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+# Le risposte contengono molte volte gli stessi orari e le stesse durate:
+# i risultati del parsing (oggetti immutabili) vengono memorizzati
+
+@functools.lru_cache(maxsize=1024)
+def _parse_duration(string):
+    m = _DURATION_RE.search(string)
+    if m is None:
+        raise ValueError("Invalid ISO 8601 duration: {!r}".format(string))
+    hours, minutes, seconds = m.groups()
+    total_seconds = 0
+    if hours is not None:
+        total_seconds += int(hours) * 3600
+    if minutes is not None:
+        total_seconds += int(minutes) * 60
+    if seconds is not None:
+        total_seconds += int(seconds)
+    return timedelta(seconds=total_seconds)
+
+
+@functools.lru_cache(maxsize=8192)
+def _parse_datetime(string, timezone=True):
+    # fromisoformat è molto più veloce di strptime ma accetta più
+    # formati: lo uso solo per le stringhe nella forma attesa
+    # (es. 2018-09-24T10:00:00+02:00) e lascio gli altri casi a strptime
+    if timezone:
+        if (len(string) == 25 and string[10] == "T" and
+                string[19] in "+-" and string[22] == ":"):
+            return datetime.fromisoformat(string)
+        return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S%z")
+    if len(string) == 19 and string[10] == "T":
+        return datetime.fromisoformat(string)
+    return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S")
+
+
+def _imap_unordered(func, items, workers):
+    '''Esegue func su ogni elemento di items su al massimo workers
+    thread e restituisce un generatore di coppie (elemento, risultato)
+    nell'ordine in cui vengono completate. Vengono tenuti in coda al
+    massimo due elementi per thread, così la memoria occupata non dipende
+    dal numero di elementi.
+    '''
+    items = iter(items)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in itertools.islice(items, workers * 2):
+                pending[executor.submit(func, item)] = item
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    for new in itertools.islice(items, 1):
+                        pending[executor.submit(func, new)] = new
+                    yield item, future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+@functools.lru_cache(maxsize=64)
+def _form_prefix(adapter, procedure):
+    '''Parte costante del corpo delle chiamate a una procedura'''
+    return urlencode({"adapter": adapter,
+                      "procedure": procedure}) + "&parameters="
+
+
+def _percentile(values, p):
+    '''Percentile p di una lista ordinata, con interpolazione lineare'''
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def _wire_bytes(response):
+    '''Byte di una risposta ricevuti dalla rete, cioè prima della
+    decompressione: quelli letti dal socket se il trasporto li conosce,
+    altrimenti il Content-Length o, in mancanza, la dimensione del corpo
+    '''
+    raw = getattr(response, "raw", None)
+    if raw is not None and hasattr(raw, "tell"):
+        received = raw.tell()
+        if received:
+            return received
+    length = getattr(response, "headers", {}).get("Content-Length")
+    return int(length) if length else len(response.content)
+
+
+def _field(item, name):
+    '''Campo name di un risultato, che sia un dizionario o un record'''
+    if isinstance(item, dict):
+        return item[name]
+    return getattr(item, name)
+
+
+class _Record():
+    '''Base dei record restituiti con records=True: oggetti con __slots__
+    che occupano molta meno memoria dei dizionari equivalenti. I record
+    (in particolare le StationRef, condivise tra più risultati) non vanno
+    modificati.
+    '''
+    __slots__ = ()
+    _fields = ()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(f, getattr(self, f)) for f in self._fields))
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f)
+                   for f in self._fields)
+
+    __hash__ = None
+
+
+class StationRef(_Record):
+    '''Riferimento a una stazione. Le istanze con gli stessi valori sono
+    condivise da tutti i record: vanno create con StationRef.intern.
+    '''
+    __slots__ = ("id", "name", "lat", "lon", "__weakref__")
+    _fields = ("id", "name", "lat", "lon")
+    _interned = weakref.WeakValueDictionary()
+    _intern_lock = threading.Lock()
+
+    def __init__(self, id, name, lat=None, lon=None):
+        self.id = id
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+
+    @classmethod
+    def intern(cls, id, name, lat=None, lon=None):
+        key = (id, name, lat, lon)
+        ref = cls._interned.get(key)
+        if ref is None:
+            with cls._intern_lock:
+                ref = cls._interned.get(key)
+                if ref is None:
+                    ref = cls._interned[key] = cls(id, name, lat, lon)
+        return ref
+
+    def __hash__(self):
+        return hash((self.id, self.name, self.lat, self.lon))
+
+    def to_dict(self, keys=("name", "id")):
+        return {k: getattr(self, k) for k in keys}
+
+
+class Vehicle(_Record):
+    __slots__ = ("dep_date", "arr_date", "category", "number",
+                 "arr_station", "dep_station", "id", "duration")
+    _fields = __slots__
+
+    def __init__(self, dep_date, arr_date, category, number, arr_station,
+                 dep_station, id, duration):
+        self.dep_date = dep_date
+        self.arr_date = arr_date
+        self.category = category
+        self.number = number
+        self.arr_station = arr_station
+        self.dep_station = dep_station
+        self.id = id
+        self.duration = duration
+
+    def to_dict(self):
+        return {"dep_date": self.dep_date,
+                "arr_date": self.arr_date,
+                "category": self.category,
+                "number": self.number,
+                "arr_station": self.arr_station.to_dict(),
+                "dep_station": self.dep_station.to_dict(),
+                "id": self.id,
+                "duration": self.duration}
+
+
+class Solution(_Record):
+    __slots__ = ("changes", "destination", "origin", "duration", "arr_date",
+                 "dep_date", "saleable", "solution_id", "vehicles",
+                 "min_points", "min_price")
+    _fields = __slots__
+
+    def __init__(self, changes, destination, origin, duration, arr_date,
+                 dep_date, saleable, solution_id, vehicles, min_points,
+                 min_price):
+        self.changes = changes
+        self.destination = destination
+        self.origin = origin
+        self.duration = duration
+        self.arr_date = arr_date
+        self.dep_date = dep_date
+        self.saleable = saleable
+        self.solution_id = solution_id
+        self.vehicles = vehicles
+        self.min_points = min_points
+        self.min_price = min_price
+
+    def to_dict(self):
+        return {"changes": self.changes,
+                "destination": self.destination.to_dict(),
+                "origin": self.origin.to_dict(),
+                "duration": self.duration,
+                "arr_date": self.arr_date,
+                "dep_date": self.dep_date,
+                "saleable": self.saleable,
+                "solution_id": self.solution_id,
+                "vehicles": [v.to_dict() for v in self.vehicles],
+                "min_points": self.min_points,
+                "min_price": self.min_price}
+
+
+class Stop(_Record):
+    __slots__ = ("reached", "type", "station", "scheduled_dep",
+                 "actual_dep", "scheduled_arr", "actual_arr",
+                 "scheduled_plat", "actual_plat")
+    _fields = __slots__
+
+    def __init__(self, reached, type, station, scheduled_dep, actual_dep,
+                 scheduled_arr, actual_arr, scheduled_plat, actual_plat):
+        self.reached = reached
+        self.type = type
+        self.station = station
+        self.scheduled_dep = scheduled_dep
+        self.actual_dep = actual_dep
+        self.scheduled_arr = scheduled_arr
+        self.actual_arr = actual_arr
+        self.scheduled_plat = scheduled_plat
+        self.actual_plat = actual_plat
+
+    def to_dict(self):
+        return {"reached": self.reached,
+                "type": self.type,
+                "station": self.station.to_dict(("id", "lat", "lon",
+                                                 "name")),
+                "scheduled_dep": self.scheduled_dep,
+                "actual_dep": self.actual_dep,
+                "scheduled_arr": self.scheduled_arr,
+                "actual_arr": self.actual_arr,
+                "scheduled_plat": self.scheduled_plat,
+                "actual_plat": self.actual_plat}
+
+
+class TrainInfo(_Record):
+    __slots__ = ("category", "number", "duration", "delay", "viaggiatreno",
+                 "checkpoint_date", "checkpoint_locality", "stops")
+    _fields = __slots__
+
+    def __init__(self, category, number, duration, delay, viaggiatreno,
+                 checkpoint_date, checkpoint_locality, stops):
+        self.category = category
+        self.number = number
+        self.duration = duration
+        self.delay = delay
+        self.viaggiatreno = viaggiatreno
+        self.checkpoint_date = checkpoint_date
+        self.checkpoint_locality = checkpoint_locality
+        self.stops = stops
+
+    def to_dict(self):
+        return {"category": self.category,
+                "number": self.number,
+                "duration": self.duration,
+                "delay": self.delay,
+                "viaggiatreno": self.viaggiatreno,
+                "checkpoint_date": self.checkpoint_date,
+                "checkpoint_locality": self.checkpoint_locality,
+                "stops": [s.to_dict() for s in self.stops]}
+
+
+class TimetableEntry(_Record):
+    __slots__ = ("category", "number", "delay", "checkpoint_date", "origin",
+                 "destination", "dep_time", "arr_time", "scheduled_plat",
+                 "actual_plat")
+    _fields = __slots__
+
+    def __init__(self, category, number, delay, checkpoint_date, origin,
+                 destination, dep_time, arr_time, scheduled_plat,
+                 actual_plat):
+        self.category = category
+        self.number = number
+        self.delay = delay
+        self.checkpoint_date = checkpoint_date
+        self.origin = origin
+        self.destination = destination
+        self.dep_time = dep_time
+        self.arr_time = arr_time
+        self.scheduled_plat = scheduled_plat
+        self.actual_plat = actual_plat
+
+    def to_dict(self):
+        return {"category": self.category,
+                "number": self.number,
+                "delay": self.delay,
+                "checkpoint_date": self.checkpoint_date,
+                "origin": self.origin.to_dict(("id", "name")),
+                "destination": self.destination.to_dict(("id", "name")),
+                "dep_time": self.dep_time,
+                "arr_time": self.arr_time,
+                "scheduled_plat": self.scheduled_plat,
+                "actual_plat": self.actual_plat}
+
+
+class LazyStops(Sequence):
+    '''Sequenza delle fermate di un treno in cui ogni fermata viene
+    decodificata solo la prima volta che viene letta
+    '''
+
+    def __init__(self, backend, raw):
+        self._backend = backend
+        self._raw = raw
+        self._parsed = [None] * len(raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._raw)))]
+        stop = self._parsed[index]
+        if stop is None:
+            stop = self._parsed[index] = self._backend._parse_stop(
+                self._raw[index])
+        return stop
+
+    def __repr__(self):
+        return "LazyStops({!r})".format(list(self))
 
+    def __eq__(self, other):
+        if isinstance(other, (LazyStops, list)):
+            return list(self) == list(other)
+        return NotImplemented
 
-class TrenitaliaBackend():
+    def _next_index(self):
+        for i, stop in enumerate(self._raw):
+            if not stop["Reached"]:
+                return i
+        return len(self._raw)
+
+    def next_stop(self):
+        '''Restituisce la prima fermata non ancora raggiunta, oppure None
+        se il treno è arrivato a destinazione
+        '''
+        i = self._next_index()
+        return self[i] if i < len(self._raw) else None
+
+    def after_checkpoint(self):
+        '''Generatore delle fermate successive all'ultima raggiunta'''
+        for i in range(self._next_index(), len(self._raw)):
+            yield self[i]
+
+
+class _TrenitaliaBase():
+    '''Parte comune ai client sincrono e asincrono: costanti, eccezioni,
+    costruzione dei parametri delle richieste e parsing delle risposte.
+    '''
     VERSION = "5.3.0.0015"  # Versione dell'app
-    VERSION_SHORT = "5.3.0"  # Versione dell'app a 3 numeri
+    VERSION_SHORT = "5.3.0"  # Versione dell'app a 3 numeri
     HOST = "https://gw71.mplat.trenitalia.it:444/"
     BACKEND_PATH = "Trenitalia50/apps/services/api/Trenitalia/android/"
     INIT_URL = f"{HOST}{BACKEND_PATH}init"
     QUERY_URL = f"{HOST}{BACKEND_PATH}query"
     NIL = {"nil": True}
+    STOP_TYPES = {"Transit": "T",
+                  "Departure": "P",
+                  "Arrival": "A",
+                  "Stop": "F"}
+    # Codici HTTP restituiti quando la sessione è scaduta e quando il
+    # gateway è temporaneamente sovraccarico
+    AUTH_STATUS = (401, 403)
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # Nome con cui lo scheduler regola l'apertura delle sessioni
+    INIT_ADAPTER = "init"
+    # Se True i metodi restituiscono record invece di dizionari
+    _records = False
+    metrics = None
+    recorder = None
+    # (device id, intestazione, intestazione serializzata)
+    _header_json = None
 
     class AuthenticationError(Exception):
         pass
@@ -76,12 +503,11 @@ class TrenitaliaBackend():
     class NoSolutionsFound(Exception):
         pass
 
-    def __init__(self):
-        self._session = requests.session()
-        self._session.headers.update({"x-wl-app-version": self.VERSION})
-        # Genero un UUID univoco che identificherà questa sessione
-        self._device_id = str(uuid.uuid4())
-        self._authenticate()
+    class ServiceUnavailable(Exception):
+        pass
+
+    class CircuitOpen(ServiceUnavailable):
+        pass
 
     def _cleanup(self, response):
         '''Ripulisce i file JSON restituiti dal server rimuovendo i tag
@@ -89,20 +515,29 @@ class TrenitaliaBackend():
         '''
         return response.replace("/*-secure-", "").replace("*/", "")
 
-    def _authenticate(self, authd=None):
-        '''Esegue l'autenticazione. Viene chiamata alla creazione
-        dell'oggetto e ogni volta che la sessione scade.
-        '''
-        if authd is None:
-            r = self._session.post(self.INIT_URL)
-            if (r.status_code != 401):
-                raise self.InvalidServerResponse("Unexpected response from "
-                                                 "server while starting new "
-                                                 "session")
-            authd = json.loads(self._cleanup(r.text))
+    def _decode(self, response):
+        '''Ripulisce e decodifica una risposta del server. Se i tag
+        compaiono solo all'inizio e alla fine della risposta il JSON viene
+        decodificato direttamente, senza creare copie della stringa.
+        '''
+        n = len(response)
+        if (response.startswith("/*-secure-") and response.endswith("*/")
+                and response.find("*/", 10, n - 2) == -1
+                and response.find("/*-secure-", 10, n - 2) == -1):
+            if orjson is not None:
+                return orjson.loads(response[10:n - 2])
+            start = _JSON_WS.match(response, 10).end()
+            obj, end = _JSON_DECODER.raw_decode(response, start)
+            if _JSON_WS.match(response, end).end() == n - 2:
+                return obj
+        return _json_loads(self._cleanup(response))
+
+    def _auth_header(self, authd):
+        '''Estrae dalla challenge del server il WL-Instance-Id e
+        costruisce l'header Authorization per completare l'autenticazione.
+        '''
         iid = authd["challenges"]["wl_antiXSRFRealm"]["WL-Instance-Id"]
         token = (authd["challenges"]["wl_deviceNoProvisioningRealm"]["token"])
-        self._session.headers.update({"WL-Instance-Id": iid})
         authh = {"wl_deviceNoProvisioningRealm": {"ID": {"app":
                     {"id": "Trenitalia", "version": self.VERSION},
                      "custom": {},
@@ -111,30 +546,68 @@ class TrenitaliaBackend():
                      "model": "unknown",
                      "os": "7.1.0"},
                      "token": token}}}
-        r = self._session.post(self.INIT_URL,
-                               headers={"Authorization": json.dumps(authh)})
-        r.raise_for_status()
-        result = json.loads(self._cleanup(r.text))
+        return iid, json.dumps(authh)
+
+    def _challenge(self, status, result):
+        '''Restituisce la challenge contenuta in una risposta alla
+        scadenza della sessione. Solo il 401 la contiene: negli altri casi
+        (es. 403) restituisce None e l'autenticazione ricomincia da capo.
+        '''
+        if (status == 401 and isinstance(result, dict) and
+                "challenges" in result):
+            return result
+        return None
+
+    def _check_handshake_status(self, status):
+        '''Controlla il codice della risposta all'header Authorization:
+        un errore temporaneo del gateway viene ripetuto dallo scheduler,
+        gli altri errori indicano che l'autenticazione è stata rifiutata
+        '''
+        if status in self.RETRY_STATUS:
+            raise self.ServiceUnavailable("Server returned status code "
+                                          "{}".format(status))
+        if status >= 400:
+            raise self.AuthenticationError("Authentication failed with "
+                                           "status code {}".format(status))
+
+    def _check_auth_result(self, result):
         if ("WL-Authentication-Success" not in result):
             raise self.AuthenticationError("Authentication failed")
 
+    def _unavailable(self, adapter, procedure, status):
+        '''Segnala un errore temporaneo del gateway'''
+        if self.metrics is not None:
+            self.metrics.increment("errors", adapter, procedure,
+                                   reason="HTTP {}".format(status))
+        raise self.ServiceUnavailable("Server returned status code "
+                                      "{}".format(status))
+
+    def _check_auth_status(self, adapter, procedure, status, attempt):
+        '''Controlla che una risposta con codice diverso da 200 sia
+        dovuta alla scadenza della sessione e che la sessione non sia
+        appena stata rinnovata
+        '''
+        if status not in self.AUTH_STATUS:
+            error = self.InvalidServerResponse("Unexpected status code "
+                                               "{}".format(status))
+        elif attempt > 0:
+            error = self.AuthenticationError("Authentication attempt failed "
+                                             "after getting non 200 status "
+                                             "code")
+        else:
+            return
+        if self.metrics is not None:
+            self.metrics.increment("errors", adapter, procedure,
+                                   reason=type(error).__name__)
+        raise error
+
     def _parse_time(self, string):
         '''Parsing delle durate in formato ISO 8601'''
-        values = re.findall(r"PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", string)[0]
-        total_seconds = 0
-        if values[0] != "":
-            total_seconds += int(values[0]) * 3600
-        if values[1] != "":
-            total_seconds += int(values[1]) * 60
-        if values[2] != "":
-            total_seconds += int(values[2])
-        return timedelta(seconds=total_seconds)
+        return _parse_duration(string)
 
     def _parse_date(self, string, timezone=True):
         '''Parsing delle date'''
-        if timezone:
-            return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S%z")
-        return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S")
+        return _parse_datetime(string, timezone)
 
     def _build_date(self, date):
         '''Costruzione di una stringa che rappresenta una data, con il
@@ -151,11 +624,7 @@ class TrenitaliaBackend():
 
     def _parse_stop_type(self, string):
         '''Parsing del tipo di fermata e conversione'''
-        convert = {"Transit": "T",
-                   "Departure": "P",
-                   "Arrival": "A",
-                   "Stop": "F"}
-        return convert[string]
+        return self.STOP_TYPES[string]
 
     def _dict2list(self, item):
         '''Converte un dizionario in una lista contenente il dizionario
@@ -166,38 +635,71 @@ class TrenitaliaBackend():
         if isinstance(item, dict):
             return [item]
 
-    def search_station(self, name, only_italian=False):
-        p = [{"AppVersion": self.VERSION_SHORT,
-              "Credentials": None,
-              "CredentialsAlias": None,
-              "DeviceId": self._device_id,
-              "Language": "IT",
-              "PlantId": "android",
-              "PointOfSaleId": 3,
-              "UnitOfWork": 0},
-              {"GetStationsRequest": {"Body": {"Name": name}}},
-              {"extractOnlyItalianStations": only_italian}]
-        for i in range(2):
-            r = self._session.post(self.QUERY_URL,
-                                   data={"adapter": "StationsAdapter",
-                                         "procedure": "GetStations",
-                                         "parameters": json.dumps(p)})
-            result = json.loads(self._cleanup(r.text))
-            if r.status_code == 200:
-                break
-            if i > 0:
-                raise self.AuthenticationError("Authentication attempt failed "
-                                               "after getting non 200 status "
-                                               "code")
-            self._authenticate(result)
+    def _build(self, adapter, procedure, parse, *args):
+        '''Esegue parse(*args), misurandone la durata se le metriche
+        sono attive
+        '''
+        metrics = self.metrics
+        if metrics is None:
+            return parse(*args)
+        start = time.perf_counter()
+        output = parse(*args)
+        metrics.observe(adapter, procedure, "build",
+                        time.perf_counter() - start)
+        return output
+
+    def _record(self, method, *args):
+        '''Passa un risultato al recorder. Un errore del recorder non fa
+        fallire la richiesta: viene solo contato nelle metriche.
+        '''
+        try:
+            getattr(self.recorder, method)(*args)
+        except Exception as e:
+            if self.metrics is not None:
+                self.metrics.increment("errors", type(self.recorder).__name__,
+                                       method, reason=type(e).__name__)
+
+    def _request_header(self):
+        '''Intestazione comune a tutti i parametri delle richieste'''
+        return {"AppVersion": self.VERSION_SHORT,
+                "Credentials": None,
+                "CredentialsAlias": None,
+                "DeviceId": self._device_id,
+                "Language": "IT",
+                "PlantId": "android",
+                "PointOfSaleId": 3,
+                "UnitOfWork": 0}
+
+    def _dump_params(self, p):
+        '''Serializza i parametri di una richiesta. L'intestazione comune
+        non cambia tra le richieste e viene serializzata una volta sola.
+        '''
+        cached = self._header_json
+        if cached is None or cached[0] != self._device_id:
+            header = self._request_header()
+            cached = self._header_json = (self._device_id, header,
+                                          "[" + json.dumps(header) + ", ")
+        if len(p) > 1 and p[0] == cached[1]:
+            return cached[2] + json.dumps(p[1:])[1:]
+        return json.dumps(p)
+
+    def _check_status(self, result):
         if (result["statusCode"] != 200):
             raise self.Non200StatusCode("Response statusCode {}: {}".format(
-                                           result["statusCode"],
-                                           result["statusReason"]))
+                                        result["statusCode"],
+                                        result["statusReason"]))
+
+    def _station_params(self, name, only_italian):
+        return [self._request_header(),
+                {"GetStationsRequest": {"Body": {"Name": name}}},
+                {"extractOnlyItalianStations": only_italian}]
+
+    def _parse_stations(self, result):
+        self._check_status(result)
         data = (result["Envelope"]["Body"]["GetStationsResponse"]["Body"]
                       ["StationDetail"])
         output = []
-        for station in data:
+        for station in self._dict2list(data) or []:
             output.append({"name": station["name"],
                            "lon": Decimal(station["longitude"])
                               if Decimal(station["longitude"]) != 0 else None,
@@ -205,12 +707,10 @@ class TrenitaliaBackend():
                               if Decimal(station["latitude"]) != 0 else None,
                            "id": int(station["stationcode"][2:]),
                            "railway": int(station["railwaycode"])})
-        return data
+        return output
 
-    def search_solution(self, origin, destination, dep_date, arr_date=None,
-                        adults=1, children=0, train_type="All",
-                        max_changes=99, limit=10):
-        cur_index = 0
+    def _solution_params(self, origin, destination, dep_date, arr_date,
+                         adults, children, train_type, max_changes):
         if dep_date is None:
             depdrange = None
         else:
@@ -219,111 +719,128 @@ class TrenitaliaBackend():
             arrdrange = None
         else:
             arrdrange = {"Start": self._build_date(arr_date), "End": None}
-        while cur_index < limit:
-            p = [{"AppVersion": self.VERSION_SHORT,
-                  "Credentials": None,
-                  "CredentialsAlias": None,
-                  "DeviceId": self._device_id,
-                  "Language": "IT",
-                  "PlantId": "android",
-                  "PointOfSaleId": 3,
-                  "UnitOfWork": 0},
-                  {"SearchTravelsRequest":
-                        {"Body": {"PagingCriteria": {"StartIndex": cur_index,
-                                                     "EndIndex": cur_index,
-                                                     "SortDirection": None},
-                                  "OriginStationId": origin,
-                                  "DestinationStationId": destination,
-                                  "DepartureDateTimeRange": depdrange,
-                                  "ArrivalDateTimeRange": arrdrange,
-                                  "ReturnDateTimeRange": None,
-                                  "ArrivalReturnDateTimeRange": None,
-                                  "IsReturn": False,
-                                  "Passengers": {"PassengerQuantity": [
-                                    {"Type": "Adult", "Quantity": adults},
-                                    {"Type": "Child", "Quantity": children}]},
-                                  "FidelityCardCode": None,
-                                  "PostSaleCriteria": None,
-                                  "TrainType": train_type,
-                                  "MaxNumberOfChanges": str(max_changes)}}}]
-            for i in range(2):
-                r = self._session.post(self.QUERY_URL,
-                                       data={"adapter": "SearchAndBuyAdapter",
-                                             "procedure": "SearchTravels",
-                                             "parameters": json.dumps(p)})
-                result = json.loads(self._cleanup(r.text))
-                if r.status_code == 200:
-                    break
-                if i > 0:
-                    raise self.AuthenticationError("Authentication attempt "
-                                                   "failed after getting non "
-                                                   "200 status code")
-                self._authenticate(result)
-            if result["statusCode"] == 500:
-                if result["statusReason"].startswith("Nessuna soluzione"):
-                    raise self.NoSolutionsFound()
-                if result["statusReason"] == ("Errore restituito dal sistema "
-                                              "centrale"):
-                    return
-            if (result["statusCode"] != 200):
-                raise self.Non200StatusCode("Response statusCode {}: {}".format(
-                                           result["statusCode"],
-                                           result["statusReason"]))
-            solution = (result["Envelope"]["Body"]["SearchTravelsResponse"]
-                        ["Body"]["PageResult"]["TravelSolution"])
-            output = {"changes": int(solution["Changes"]),
-                           "destination":
-                              {"name": solution["DestinationStation"]["Name"],
-                               "id": solution["DestinationStation"]["Id"]},
-                            "origin":
-                              {"name": solution["OriginStation"]["Name"],
-                               "id": solution["OriginStation"]["Id"]},
-                            "duration": self._parse_time(
-                                solution["TotalJourneyTime"]),
-                            "arr_date": self._parse_date(
-                                solution["ArrivalDateTime"]),
-                            "dep_date": self._parse_date(
-                                solution["DepartureDateTime"]),
-                            "saleable": solution["IsSaleable"],
-                            "solution_id": solution["SolutionId"],
-                            "vehicles": [],
-                            "min_points": Decimal(solution["MinLoyaltyPoints"])
-                                if "MinLoyaltyPoints" in solution and
-                                solution["MinLoyaltyPoints"] != self.NIL
-                                else None,
-                            "min_price": Decimal(solution["MinPrice"])
-                                if solution["MinPrice"] != self.NIL else None}
-            for v in self._dict2list(solution["Nodes"]["SolutionNode"]):
-                vh_data = {"dep_date": self._parse_date(
-                                        v["DepartureDateTime"]),
-                           "arr_date": self._parse_date(
-                                        v["ArrivalDateTime"]),
-                           "category": (v["Train"]["CategoryCode"],
-                                        v["Train"]["CategoryName"]),
-                           "number": v["Train"]["Number"],
-                           "arr_station":
-                                {"name": v["ArrivalStation"]["Name"],
-                                 "id": v["ArrivalStation"]["Id"]},
-                           "dep_station":
-                                {"name":v["DepartureStation"]["Name"],
-                                 "id": v["DepartureStation"]["Id"]},
-                           "id": v["Id"],
-                           "duration": self._parse_time(
-                                        v["JourneyDuration"])}
-                output["vehicles"].append(vh_data)
-            yield output
-            cur_index += 1
-
-    def train_info(self, number, dep_st=None, arr_st=None, dep_date=None):
-        p = [{"AppVersion": self.VERSION_SHORT,
-              "Credentials": None,
-              "CredentialsAlias": None,
-              "DeviceId": self._device_id,
-              "Language": "IT",
-              "PlantId": "android",
-              "PointOfSaleId": 3,
-              "UnitOfWork": 0},
-              {"TrainRealtimeInfoRequest":
+        return [self._request_header(),
+                {"SearchTravelsRequest":
+                    {"Body": {"PagingCriteria": None,
+                              "OriginStationId": origin,
+                              "DestinationStationId": destination,
+                              "DepartureDateTimeRange": depdrange,
+                              "ArrivalDateTimeRange": arrdrange,
+                              "ReturnDateTimeRange": None,
+                              "ArrivalReturnDateTimeRange": None,
+                              "IsReturn": False,
+                              "Passengers": {"PassengerQuantity": [
+                                {"Type": "Adult", "Quantity": adults},
+                                {"Type": "Child", "Quantity": children}]},
+                              "FidelityCardCode": None,
+                              "PostSaleCriteria": None,
+                              "TrainType": train_type,
+                              "MaxNumberOfChanges": str(max_changes)}}}]
+
+    def _page_params(self, p, start, end):
+        '''Serializza i parametri di ricerca per le soluzioni comprese
+        tra gli indici start ed end (inclusi)
+        '''
+        body = p[1]["SearchTravelsRequest"]["Body"]
+        body["PagingCriteria"] = {"StartIndex": start,
+                                  "EndIndex": end,
+                                  "SortDirection": None}
+        return self._dump_params(p)
+
+    def _parse_solution_page(self, result):
+        '''Restituisce la lista delle soluzioni grezze contenute nella
+        risposta, oppure None se il server non ha altri risultati.
+        '''
+        if result["statusCode"] == 500:
+            if result["statusReason"].startswith("Nessuna soluzione"):
+                raise self.NoSolutionsFound()
+            if result["statusReason"] == ("Errore restituito dal sistema "
+                                          "centrale"):
+                return None
+        self._check_status(result)
+        return self._dict2list(result["Envelope"]["Body"]
+                               ["SearchTravelsResponse"]["Body"]
+                               ["PageResult"]["TravelSolution"]) or []
+
+    def _category(self, code, name):
+        '''Restituisce la coppia (codice, nome) della categoria di un
+        treno; con i record attivi le coppie uguali vengono condivise
+        '''
+        if self._records:
+            return _CATEGORIES.setdefault((code, name), (code, name))
+        return (code, name)
+
+    def _parse_solution(self, solution):
+        '''Parsing di una singola soluzione di viaggio'''
+        records = self._records
+        vehicles = []
+        for v in self._dict2list(solution["Nodes"]["SolutionNode"]):
+            dep_date = self._parse_date(v["DepartureDateTime"])
+            arr_date = self._parse_date(v["ArrivalDateTime"])
+            category = self._category(v["Train"]["CategoryCode"],
+                                      v["Train"]["CategoryName"])
+            duration = self._parse_time(v["JourneyDuration"])
+            if records:
+                vehicles.append(Vehicle(
+                    dep_date, arr_date, category, v["Train"]["Number"],
+                    StationRef.intern(v["ArrivalStation"]["Id"],
+                                      v["ArrivalStation"]["Name"]),
+                    StationRef.intern(v["DepartureStation"]["Id"],
+                                      v["DepartureStation"]["Name"]),
+                    v["Id"], duration))
+                continue
+            vh_data = {"dep_date": dep_date,
+                       "arr_date": arr_date,
+                       "category": category,
+                       "number": v["Train"]["Number"],
+                       "arr_station":
+                            {"name": v["ArrivalStation"]["Name"],
+                             "id": v["ArrivalStation"]["Id"]},
+                       "dep_station":
+                            {"name":v["DepartureStation"]["Name"],
+                             "id": v["DepartureStation"]["Id"]},
+                       "id": v["Id"],
+                       "duration": duration}
+            vehicles.append(vh_data)
+        duration = self._parse_time(solution["TotalJourneyTime"])
+        arr_date = self._parse_date(solution["ArrivalDateTime"])
+        dep_date = self._parse_date(solution["DepartureDateTime"])
+        min_points = (Decimal(solution["MinLoyaltyPoints"])
+                      if "MinLoyaltyPoints" in solution and
+                      solution["MinLoyaltyPoints"] != self.NIL else None)
+        min_price = (Decimal(solution["MinPrice"])
+                     if solution["MinPrice"] != self.NIL else None)
+        if records:
+            return Solution(int(solution["Changes"]),
+                            StationRef.intern(
+                                solution["DestinationStation"]["Id"],
+                                solution["DestinationStation"]["Name"]),
+                            StationRef.intern(
+                                solution["OriginStation"]["Id"],
+                                solution["OriginStation"]["Name"]),
+                            duration, arr_date, dep_date,
+                            solution["IsSaleable"], solution["SolutionId"],
+                            vehicles, min_points, min_price)
+        output = {"changes": int(solution["Changes"]),
+                       "destination":
+                          {"name": solution["DestinationStation"]["Name"],
+                           "id": solution["DestinationStation"]["Id"]},
+                        "origin":
+                          {"name": solution["OriginStation"]["Name"],
+                           "id": solution["OriginStation"]["Id"]},
+                        "duration": duration,
+                        "arr_date": arr_date,
+                        "dep_date": dep_date,
+                        "saleable": solution["IsSaleable"],
+                        "solution_id": solution["SolutionId"],
+                        "vehicles": vehicles,
+                        "min_points": min_points,
+                        "min_price": min_price}
+        return output
+
+    def _train_params(self, number, dep_st, arr_st, dep_date):
+        return [self._request_header(),
+                {"TrainRealtimeInfoRequest":
                     {"Body": {"ArrivalStationId": arr_st,
                               "DepartureDate": self._build_date(dep_date),
                               "DepartureStationId": dep_st,
@@ -331,28 +848,14 @@ class TrenitaliaBackend():
                                         "CategoryName": None,
                                         "Notifiable": None,
                                         "Number": number}}}}]
-        for i in range(2):
-            r = self._session.post(self.QUERY_URL,
-                                   data={"adapter": "TrainRealtimeInfoAdapter",
-                                   "procedure": "TrainRealtimeInfo",
-                                   "parameters": json.dumps(p)})
-            result = json.loads(self._cleanup(r.text))
-            if r.status_code == 200:
-                break
-            if i > 0:
-                raise self.AuthenticationError("Authentication attempt failed "
-                                               "after getting non 200 status "
-                                               "code")
-            self._authenticate(result)
+
+    def _parse_train_info(self, result, lazy=False):
         if result["statusCode"] == 500:
             if result["statusReason"] == "Treno non valido":
                 raise self.TrainNotFound()
             if result["statusReason"] == "Il treno e' cancellato":
                 raise self.TrainCancelled()
-        if (result["statusCode"] != 200):
-            raise self.Non200StatusCode("Response statusCode {}: {}".format(
-                                        result["statusCode"],
-                                        result["statusReason"]))
+        self._check_status(result)
         data = (result["Envelope"]["Body"]["TrainRealtimeInfoResponse"]["Body"]
                       ["RealtimeTrainInfoWithStops"])
         if isinstance(data, list):
@@ -364,99 +867,2680 @@ class TrenitaliaBackend():
             chkloc = data["LastReachedCheckPoint"]
         else:
             chkloc = None
-        output = {"category": (data["Train"]["CategoryCode"],
-                               data["Train"]["CategoryName"]),
+        category = self._category(data["Train"]["CategoryCode"],
+                                  data["Train"]["CategoryName"])
+        if lazy:
+            stops = LazyStops(self, data["Stops"]["RealtimeTrainStop"])
+        else:
+            stops = [self._parse_stop(stop)
+                     for stop in data["Stops"]["RealtimeTrainStop"]]
+        if self._records:
+            return TrainInfo(category, data["Train"]["Number"],
+                             self._parse_time(data["ScheduledDuration"]),
+                             self._parse_time(data["Delay"]),
+                             data["IsViaggiaTreno"], chkpdate, chkloc, stops)
+        output = {"category": category,
                   "number": data["Train"]["Number"],
                   "duration": self._parse_time(data["ScheduledDuration"]),
                   "delay": self._parse_time(data["Delay"]),
                   "viaggiatreno": data["IsViaggiaTreno"],
                   "checkpoint_date": chkpdate,
                   "checkpoint_locality": chkloc,
-                  "stops": []}
-        for stop in data["Stops"]["RealtimeTrainStop"]:
-            if stop["ScheduledInfo"]["Departure"] != self.NIL:
-                sch_dep = self._parse_date(stop["ScheduledInfo"]["Departure"])
-            else:
-                sch_dep = None
-            if stop["ScheduledInfo"]["Arrival"] != self.NIL:
-                sch_arr = self._parse_date(stop["ScheduledInfo"]["Arrival"])
+                  "stops": stops}
+        return output
+
+    def _parse_stop(self, stop):
+        '''Parsing di una fermata di un treno'''
+        if stop["ScheduledInfo"]["Departure"] != self.NIL:
+            sch_dep = self._parse_date(stop["ScheduledInfo"]["Departure"])
+        else:
+            sch_dep = None
+        if stop["ScheduledInfo"]["Arrival"] != self.NIL:
+            sch_arr = self._parse_date(stop["ScheduledInfo"]["Arrival"])
+        else:
+            sch_arr = None
+        if stop["ActualInfo"]["Departure"] != self.NIL:
+            act_dep = self._parse_date(stop["ActualInfo"]["Departure"])
+        else:
+            act_dep = None
+        if stop["ActualInfo"]["Arrival"] != self.NIL:
+            act_arr = self._parse_date(stop["ActualInfo"]["Arrival"])
+        else:
+            act_arr = None
+        if stop["ActualInfo"]["Track"] != "":
+            sch_plat = stop["ActualInfo"]["Track"]
+        else:
+            sch_plat = None
+        if stop["ActualInfo"]["Track"] != "":
+            act_plat = stop["ActualInfo"]["Track"]
+        else:
+            act_plat = None
+        if self._records:
+            return Stop(stop["Reached"],
+                        self._parse_stop_type(stop["StopType"]),
+                        StationRef.intern(stop["Station"]["Id"],
+                                          stop["Station"]["Name"],
+                                          stop["Station"]["Latitude"],
+                                          stop["Station"]["Longitude"]),
+                        sch_dep, act_dep, sch_arr, act_arr, sch_plat,
+                        act_plat)
+        return {"reached": stop["Reached"],
+                "type": self._parse_stop_type(stop["StopType"]),
+                "station": {"id": stop["Station"]["Id"],
+                            "lat": stop["Station"]["Latitude"],
+                            "lon": stop["Station"]["Longitude"],
+                            "name": stop["Station"]["Name"]},
+                "scheduled_dep": sch_dep,
+                "actual_dep": act_dep,
+                "scheduled_arr": sch_arr,
+                "actual_arr": act_arr,
+                "scheduled_plat": sch_plat,
+                "actual_plat": act_plat}
+
+    def _timetable_params(self, station_id, ttype):
+        header = self._request_header()
+        header.update({"StationId": station_id, "Type": ttype.upper()})
+        return [header, None]
+
+    def _parse_timetable(self, result, parse_row=None):
+        parse_row = parse_row or self._parse_timetable_row
+        return [parse_row(train) for train in result["trains"]]
+
+    def _parse_timetable_row(self, train):
+        '''Parsing di una riga del tabellone arrivi/partenze'''
+        try:
+            chkpdate = self._parse_date(train["LastReachedCheckPointBase"])
+        except TypeError:
+            chkpdate = None
+        category = self._category(train["category"]["code"],
+                                  train["category"]["name"])
+        sch_plat = (train["scheduledTrack"]
+                    if train["scheduledTrack"] != "" else None)
+        act_plat = (train["actualTrack"]
+                    if train["actualTrack"] != "" else None)
+        if self._records:
+            return TimetableEntry(category, train["number"],
+                                  self._parse_time(train["delay"]), chkpdate,
+                                  StationRef.intern(train["originId"],
+                                                    train["originName"]),
+                                  StationRef.intern(train["destinationId"],
+                                                    train["destinationName"]),
+                                  train["departureTime"],
+                                  train["arrivalTime"], sch_plat, act_plat)
+        return {"category": category,
+                "number": train["number"],
+                "delay": self._parse_time(train["delay"]),
+                "checkpoint_date": chkpdate,
+                "origin": {"id": train["originId"],
+                           "name":  train["originName"]},
+                "destination": {"id": train["destinationId"],
+                                "name":  train["destinationName"]},
+                "dep_time": train["departureTime"],
+                "arr_time": train["arrivalTime"],
+                "scheduled_plat": sch_plat,
+                "actual_plat": act_plat}
+
+
+class SessionStore():
+    '''Salva su disco i dati di una sessione autenticata (device id,
+    WL-Instance-Id e cookie), in modo che un nuovo processo possa
+    riutilizzarla senza ripetere l'autenticazione.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, url):
+        '''Restituisce la sessione salvata per url, oppure None'''
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("url") != url:
+            return None
+        return data
+
+    def save(self, url, device_id, instance_id, cookies):
+        '''Salva la sessione; cookies è una lista di dizionari con le
+        chiavi name, value, domain e path
+        '''
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump({"url": url,
+                       "device_id": device_id,
+                       "instance_id": instance_id,
+                       "cookies": cookies}, f)
+        os.replace(tmp, self.path)
+
+
+class Cache():
+    '''Interfaccia comune delle cache delle risposte del server. Le
+    sottoclassi implementano get e set; i contatori in stats vengono
+    aggiornati anche dal backend (coalesced conta le richieste identiche
+    che hanno atteso il risultato di una richiesta già in corso).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0,
+                      "expired": 0, "coalesced": 0}
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] += n
+
+    def get(self, key):
+        '''Restituisce il valore associato a key, oppure None'''
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        '''Associa value a key per ttl secondi'''
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    '''Cache in memoria con politica LRU e scadenza degli elementi'''
+
+    def __init__(self, maxsize=1024):
+        super().__init__()
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+
+
+class SQLiteCache(Cache):
+    '''Cache su database SQLite, condivisibile tra più processi. Le
+    risposte vengono salvate in formato JSON.
+    '''
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache "
+                             "(key TEXT PRIMARY KEY, expires REAL, "
+                             "value TEXT)")
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT expires, value FROM cache "
+                                   "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            if row[0] < time.time():
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+        return json.loads(row[1])
+
+    def set(self, key, value, ttl):
+        value = json.dumps(value)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                             (key, time.time() + ttl, value))
+
+    def purge(self):
+        '''Elimina dal database gli elementi scaduti'''
+        with self._lock:
+            n = self._db.execute("DELETE FROM cache WHERE expires < ?",
+                                 (time.time(),)).rowcount
+            self.stats["evictions"] += n
+
+    def close(self):
+        self._db.close()
+
+
+class Metrics():
+    '''Raccoglie le metriche delle chiamate al backend, suddivise per
+    adapter e procedura: istogrammi delle durate delle fasi (network:
+    invio della richiesta e ricezione della risposta; charset:
+    conversione del corpo in testo; decode: rimozione dei tag e
+    decodifica del JSON; build: costruzione del risultato) e contatori
+    dei byte ricevuti dalla rete (compressi, se la risposta lo è), delle
+    nuove autenticazioni, degli errori (per statusReason) e dell'uso
+    della cache. Ogni misura viene passata anche alle funzioni registrate con
+    add_hook, che ricevono nome, etichette e valore.
+    '''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+    HELP = {"phase_seconds": "Time spent in each phase of a query",
+            "received_bytes": "Bytes received from the backend on the "
+                              "wire, before decompression",
+            "reauth": "Authentications repeated after an expired session",
+            "errors": "Failed queries, by status reason",
+            "cache": "Cache lookups, by result"}
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self._lock = threading.Lock()
+        # (adapter, procedure, phase) -> [conteggi per bucket, somma, totale]
+        self.histograms = {}
+        # (nome, etichette) -> valore
+        self.counters = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def observe(self, adapter, procedure, phase, seconds):
+        '''Registra la durata di una fase di una chiamata'''
+        i = bisect.bisect_left(self.buckets, seconds)
+        key = (adapter, procedure, phase)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+        for hook in self._hooks:
+            hook("phase_seconds", {"adapter": adapter, "procedure": procedure,
+                                   "phase": phase}, seconds)
+
+    def increment(self, name, adapter, procedure, value=1, **labels):
+        '''Incrementa un contatore'''
+        labels = dict(adapter=adapter, procedure=procedure, **labels)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for hook in self._hooks:
+            hook(name, labels, value)
+
+    @staticmethod
+    def _labels(labels):
+        return ",".join('{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                     .replace("\n", "\\n"))
+            for k, v in labels)
+
+    def to_prometheus(self, prefix="trenitalia"):
+        '''Esporta le metriche nel formato testuale di Prometheus'''
+        lines = []
+        with self._lock:
+            histograms = sorted((k, (list(v[0]), v[1], v[2]))
+                                for k, v in self.histograms.items())
+            counters = sorted(self.counters.items())
+        if histograms:
+            name = prefix + "_phase_seconds"
+            lines.append("# HELP {} {}".format(name,
+                                               self.HELP["phase_seconds"]))
+            lines.append("# TYPE {} histogram".format(name))
+        for (adapter, procedure, phase), (counts, total, n) in histograms:
+            labels = (("adapter", adapter), ("procedure", procedure),
+                      ("phase", phase))
+            cumulative = 0
+            for le, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("{}_bucket{{{},le=\"{}\"}} {}".format(
+                    name, self._labels(labels), repr(float(le)), cumulative))
+            lines.append("{}_bucket{{{},le=\"+Inf\"}} {}".format(
+                name, self._labels(labels), n))
+            lines.append("{}_sum{{{}}} {}".format(name, self._labels(labels),
+                                                 repr(total)))
+            lines.append("{}_count{{{}}} {}".format(name,
+                                                   self._labels(labels), n))
+        last = None
+        for (counter, labels), value in counters:
+            name = "{}_{}_total".format(prefix, counter)
+            if counter != last:
+                lines.append("# HELP {} {}".format(name, self.HELP.get(
+                    counter, counter)))
+                lines.append("# TYPE {} counter".format(name))
+                last = counter
+            lines.append("{}{{{}}} {}".format(name, self._labels(labels),
+                                              value))
+        return "\n".join(lines) + "\n"
+
+
+class _AdapterState():
+    '''Stato di RequestScheduler per un adapter'''
+    __slots__ = ("rate", "tokens", "updated", "queued", "retrying",
+                 "in_flight", "requests", "retries", "failures", "rejected",
+                 "consecutive", "opened_at", "trial")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.queued = 0
+        self.retrying = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        # Errori temporanei consecutivi e istante di apertura del circuito
+        self.consecutive = 0
+        self.opened_at = None
+        # True mentre è in corso la richiesta di prova a circuito aperto
+        self.trial = False
+
+
+class RequestScheduler():
+    '''Regola l'invio delle richieste al backend, separatamente per ogni
+    adapter:
+    * limita la frequenza delle richieste con un token bucket: rates
+      contiene il numero di richieste al secondo per ogni adapter ("*"
+      per quelli non indicati, nessun limite se manca) e burst il numero
+      di richieste che possono partire insieme;
+    * ripete fino a max_retries volte le richieste fallite per errori
+      temporanei (errori di rete, timeout, codici HTTP 429 e 5xx), con
+      un'attesa casuale compresa tra zero e backoff * 2^tentativo secondi
+      (al massimo max_backoff); le sessioni scadute vengono rinnovate dal
+      backend e non sono considerate errori;
+    * dopo failure_threshold errori temporanei consecutivi apre il
+      circuito: per reset_timeout secondi le richieste falliscono subito
+      con CircuitOpen, poi ne viene lasciata passare una di prova che, se
+      riesce, chiude di nuovo il circuito; gli altri errori non
+      interrompono la serie di errori temporanei né chiudono il circuito.
+    L'apertura di una nuova sessione viene regolata come l'adapter
+    "init".
+    Lo stesso oggetto può essere condiviso da più backend, anche
+    asincroni.
+    '''
+    TRANSIENT = (requests.ConnectionError, requests.Timeout)
+    if aiohttp is not None:
+        TRANSIENT += (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    def __init__(self, rates=None, burst=1, max_retries=3, backoff=0.5,
+                 max_backoff=30, failure_threshold=5, reset_timeout=30):
+        self.rates = dict(rates or {})
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._adapters = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        '''Per ogni adapter: richieste in attesa di un token (queued) o di
+        essere ripetute (retrying), in corso (in_flight), stato del
+        circuito e contatori di richieste, ripetizioni, errori temporanei
+        e richieste rifiutate a circuito aperto
+        '''
+        with self._lock:
+            return {adapter: {"queued": s.queued,
+                              "retrying": s.retrying,
+                              "in_flight": s.in_flight,
+                              "state": self._circuit(s),
+                              "requests": s.requests,
+                              "retries": s.retries,
+                              "failures": s.failures,
+                              "rejected": s.rejected}
+                    for adapter, s in self._adapters.items()}
+
+    def _circuit(self, state):
+        if state.opened_at is None:
+            return "closed"
+        if state.trial:
+            return "half-open"
+        return "open"
+
+    def _transient(self, error):
+        return (isinstance(error, self.TRANSIENT) or
+                isinstance(error, _TrenitaliaBase.ServiceUnavailable))
+
+    def _admit(self, adapter):
+        '''Registra una nuova richiesta e restituisce lo stato
+        dell'adapter e il tempo da attendere prima di inviarla
+        '''
+        now = time.monotonic()
+        with self._lock:
+            state = self._adapters.get(adapter)
+            if state is None:
+                state = self._adapters[adapter] = _AdapterState(
+                    self.rates.get(adapter, self.rates.get("*")),
+                    self.burst)
+            if state.opened_at is not None:
+                if (state.trial or
+                        now - state.opened_at < self.reset_timeout):
+                    state.rejected += 1
+                    raise _TrenitaliaBase.CircuitOpen(
+                        "Too many failures from {}, not sending "
+                        "requests".format(adapter))
+                state.trial = True
+            state.requests += 1
+            state.queued += 1
+            if not state.rate:
+                return state, 0
+            # Il token viene prenotato subito, così le richieste in
+            # attesa partono nell'ordine in cui sono arrivate
+            state.tokens = min(self.burst, state.tokens +
+                               (now - state.updated) * state.rate) - 1
+            state.updated = now
+            return state, max(0, -state.tokens / state.rate)
+
+    def _start(self, state):
+        with self._lock:
+            state.queued -= 1
+            state.in_flight += 1
+
+    def _finish(self, state, error):
+        '''Registra l'esito di una richiesta e aggiorna il circuito.
+        Solo una richiesta riuscita (error None) chiude il circuito e
+        azzera gli errori consecutivi; un errore non temporaneo (es. una
+        risposta non valida) non cambia lo stato del circuito.
+        '''
+        with self._lock:
+            state.in_flight -= 1
+            if error is None:
+                state.consecutive = 0
+                state.opened_at = None
+                state.trial = False
+                return
+            if not self._transient(error):
+                # Il circuito resta aperto: passerà un'altra prova
+                state.trial = False
+                return
+            state.failures += 1
+            state.consecutive += 1
+            if state.trial or state.consecutive >= self.failure_threshold:
+                state.opened_at = time.monotonic()
+                state.trial = False
+
+    def _retry_delay(self, state, attempt):
+        with self._lock:
+            state.retries += 1
+            state.retrying += 1
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _retried(self, state):
+        with self._lock:
+            state.retrying -= 1
+
+    def call(self, adapter, func):
+        '''Esegue func() per una richiesta ad adapter, rispettando i
+        limiti di frequenza e ripetendola in caso di errori temporanei
+        '''
+        attempt = 0
+        while True:
+            state, delay = self._admit(adapter)
+            if delay:
+                time.sleep(delay)
+            self._start(state)
+            try:
+                result = func()
+            except BaseException as e:
+                self._finish(state, e)
+                if not self._transient(e) or attempt >= self.max_retries:
+                    raise
             else:
-                sch_arr = None
-            if stop["ActualInfo"]["Departure"] != self.NIL:
-                act_dep = self._parse_date(stop["ActualInfo"]["Departure"])
+                self._finish(state, None)
+                return result
+            time.sleep(self._retry_delay(state, attempt))
+            self._retried(state)
+            attempt += 1
+
+    async def call_async(self, adapter, func):
+        '''Come call, per una funzione che restituisce una coroutine'''
+        attempt = 0
+        while True:
+            state, delay = self._admit(adapter)
+            if delay:
+                await asyncio.sleep(delay)
+            self._start(state)
+            try:
+                result = await func()
+            except BaseException as e:
+                self._finish(state, e)
+                if not self._transient(e) or attempt >= self.max_retries:
+                    raise
             else:
-                act_dep = None
-            if stop["ActualInfo"]["Arrival"] != self.NIL:
-                act_arr = self._parse_date(stop["ActualInfo"]["Arrival"])
+                self._finish(state, None)
+                return result
+            await asyncio.sleep(self._retry_delay(state, attempt))
+            self._retried(state)
+            attempt += 1
+
+
+class Transport():
+    '''Interfaccia del trasporto HTTP usato da TrenitaliaBackend. Ogni
+    istanza corrisponde a una sessione: conserva le intestazioni comuni a
+    tutte le richieste e i cookie. post restituisce un oggetto con gli
+    attributi status_code, text e content e il metodo raise_for_status,
+    come requests.Response.
+    '''
+
+    def post(self, url, data=None, headers=None):
+        '''Invia una richiesta POST con corpo data e le intestazioni
+        headers in aggiunta a quelle della sessione
+        '''
+        raise NotImplementedError
+
+    def set_header(self, name, value):
+        '''Imposta un'intestazione inviata con tutte le richieste'''
+        raise NotImplementedError
+
+    def get_cookies(self):
+        '''Cookie della sessione, come dizionari con le chiavi name,
+        value, domain e path
+        '''
+        raise NotImplementedError
+
+    def set_cookie(self, name, value, domain, path):
+        raise NotImplementedError
+
+    def resize(self, size):
+        '''Permette almeno size richieste contemporanee'''
+        pass
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    '''Trasporto predefinito, basato su una sessione di requests:
+    * mantiene aperte fino a pool_size connessioni per host (con
+      keep_alive=False ogni connessione viene chiusa dopo la risposta);
+    * con compress=True chiede risposte compresse con tutti i formati
+      supportati da requests (gzip e deflate, oltre a br e zstd se sono
+      installati i moduli necessari), con compress=False risposte non
+      compresse;
+    * timeout è l'attesa massima in secondi per la connessione e per la
+      risposta (un numero oppure una coppia (connessione, lettura);
+      None = nessun limite).
+    '''
+
+    def __init__(self, pool_size=10, timeout=(10, 30), keep_alive=True,
+                 compress=True):
+        self.timeout = timeout
+        self._session = requests.session()
+        if not compress:
+            self._session.headers["Accept-Encoding"] = "identity"
+        if not keep_alive:
+            self._session.headers["Connection"] = "close"
+        self._pool_size = 0
+        self.resize(pool_size)
+
+    def post(self, url, data=None, headers=None):
+        return self._session.post(url, data=data, headers=headers,
+                                  timeout=self.timeout)
+
+    def set_header(self, name, value):
+        self._session.headers[name] = value
+
+    def get_cookies(self):
+        return [{"name": c.name, "value": c.value, "domain": c.domain,
+                 "path": c.path} for c in self._session.cookies]
+
+    def set_cookie(self, name, value, domain, path):
+        self._session.cookies.set(name, value, domain=domain, path=path)
+
+    def resize(self, size):
+        if size <= self._pool_size:
+            return
+        old = {self._session.adapters.get(prefix)
+               for prefix in ("https://", "http://")}
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._pool_size = size
+        # Le connessioni dei vecchi adapter ancora in uso vengono chiuse
+        # quando la richiesta termina
+        for a in old:
+            if a is not None:
+                a.close()
+
+    def close(self):
+        self._session.close()
+
+
+def _exchange_key(url, data, headers):
+    '''Chiave con cui RecordingTransport e ReplayTransport identificano
+    una richiesta. Il device id (un UUID) cambia a ogni sessione e viene
+    escluso.
+    '''
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    elif isinstance(data, dict):
+        data = urlencode(data)
+    auth = headers is not None and "Authorization" in headers
+    return "{} {} {}".format(urlsplit(url).path, "auth" if auth else "-",
+                             _UUID_RE.sub("", data or ""))
+
+
+class _ReplayedResponse():
+    __slots__ = ("status_code", "text")
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def content(self):
+        return self.text.encode("utf-8")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError("{} Error in replayed response".format(
+                self.status_code), response=self)
+
+
+class RecordingTransport(Transport):
+    '''Inoltra le richieste a transport (di default RequestsTransport) e
+    aggiunge ogni scambio al file path, una riga JSON per scambio, in
+    modo che possa essere riprodotto con ReplayTransport
+    '''
+
+    def __init__(self, path, transport=None):
+        self.transport = transport or RequestsTransport()
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, headers=None):
+        r = self.transport.post(url, data, headers)
+        line = json.dumps({"key": _exchange_key(url, data, headers),
+                           "status": r.status_code, "body": r.text})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+        return r
+
+    def set_header(self, name, value):
+        self.transport.set_header(name, value)
+
+    def get_cookies(self):
+        return self.transport.get_cookies()
+
+    def set_cookie(self, name, value, domain, path):
+        self.transport.set_cookie(name, value, domain, path)
+
+    def resize(self, size):
+        self.transport.resize(size)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.transport.close()
+
+
+class ReplayTransport(Transport):
+    '''Risponde alle richieste con gli scambi salvati da
+    RecordingTransport, senza accesso alla rete. Le risposte a richieste
+    identiche vengono restituite nell'ordine in cui sono state
+    registrate; esaurite quelle, viene ripetuta l'ultima. Una richiesta
+    mai registrata solleva MissingExchange.
+    '''
+
+    class MissingExchange(Exception):
+        pass
+
+    def __init__(self, path):
+        self._exchanges = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                exchange = json.loads(line)
+                self._exchanges.setdefault(exchange["key"], []).append(
+                    _ReplayedResponse(exchange["status"], exchange["body"]))
+        self._served = {}
+        self._headers = {}
+        self._cookies = []
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, headers=None):
+        key = _exchange_key(url, data, headers)
+        responses = self._exchanges.get(key)
+        if responses is None:
+            raise self.MissingExchange("No recorded response for " + key)
+        with self._lock:
+            n = self._served.get(key, 0)
+            self._served[key] = n + 1
+        return responses[min(n, len(responses) - 1)]
+
+    def set_header(self, name, value):
+        self._headers[name] = value
+
+    def get_cookies(self):
+        return list(self._cookies)
+
+    def set_cookie(self, name, value, domain, path):
+        self._cookies.append({"name": name, "value": value,
+                              "domain": domain, "path": path})
+
+
+class TrenitaliaBackend(_TrenitaliaBase):
+    # Durata in secondi delle risposte in cache per ogni adapter
+    CACHE_TTL = {"StationsAdapter": 86400,
+                 "SearchAndBuyAdapter": 60,
+                 "TrainRealtimeInfoAdapter": 20,
+                 "GetStationTimetables": 20}
+
+    def __init__(self, pool_size=10, lazy=False, session_store=None,
+                 cache=None, cache_ttl=None, records=False, metrics=None,
+                 scheduler=None, recorder=None, transport=None):
+        self._setup(records, metrics, recorder, scheduler, cache, cache_ttl)
+        self._transport = transport or RequestsTransport(pool_size)
+        self._transport.set_header("x-wl-app-version", self.VERSION)
+        self._resize_pool(pool_size)
+        self._session_store = session_store
+        self._auth_lock = threading.Lock()
+        # Viene incrementato a ogni autenticazione riuscita, in modo che
+        # i thread che ricevono un 401 contemporaneamente ne eseguano
+        # una sola
+        self._auth_generation = 0
+        if session_store is not None:
+            saved = session_store.load(self.INIT_URL)
+        else:
+            saved = None
+        if saved is not None:
+            # Riutilizzo la sessione salvata: se è scaduta il server
+            # risponderà con un 401 e verrà rinnovata
+            self._device_id = saved["device_id"]
+            self._transport.set_header("WL-Instance-Id",
+                                       saved["instance_id"])
+            for c in saved["cookies"]:
+                self._transport.set_cookie(c["name"], c["value"],
+                                           c["domain"], c["path"])
+            self._auth_generation = 1
+        else:
+            # Genero un UUID univoco che identificherà questa sessione
+            self._device_id = str(uuid.uuid4())
+            if not lazy:
+                self._open_session()
+
+    def _setup(self, records, metrics, recorder, scheduler, cache,
+               cache_ttl):
+        '''Inizializzazione comune a TrenitaliaBackend e SessionPool'''
+        self._records = records
+        self.metrics = metrics
+        self.recorder = recorder
+        self.scheduler = scheduler or RequestScheduler()
+        self.cache = cache
+        self._cache_ttl = dict(self.CACHE_TTL)
+        if cache_ttl is not None:
+            self._cache_ttl.update(cache_ttl)
+        # Richieste in corso, per far sì che richieste identiche fatte da
+        # più thread contemporaneamente producano una sola chiamata
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _open_session(self):
+        '''Prima autenticazione della sessione, attraverso lo scheduler'''
+        self.scheduler.call(self.INIT_ADAPTER, functools.partial(
+            self._authenticate, generation=0))
+
+    def _resize_pool(self, size):
+        '''Dimensiona il pool di connessioni HTTP della sessione'''
+        self._transport.resize(size)
+
+    def close(self):
+        self._transport.close()
+
+    def _authenticate(self, authd=None, generation=None):
+        '''Esegue l'autenticazione. Viene chiamata alla creazione
+        dell'oggetto e ogni volta che la sessione scade. Se generation non
+        corrisponde più a quella corrente un altro thread si è già
+        autenticato nel frattempo e non è necessario fare nulla.
+        '''
+        with self._auth_lock:
+            if (generation is not None and
+                    generation != self._auth_generation):
+                return
+            if authd is None:
+                r = self._transport.post(self.INIT_URL)
+                status = r.status_code
+                if status in self.RETRY_STATUS:
+                    raise self.ServiceUnavailable("Server returned status "
+                                                  "code {}".format(status))
+                if (status != 401):
+                    raise self.InvalidServerResponse("Unexpected response "
+                                                     "from server while "
+                                                     "starting new session")
+                authd = self._decode(r.text)
+            iid, authh = self._auth_header(authd)
+            self._transport.set_header("WL-Instance-Id", iid)
+            r = self._transport.post(self.INIT_URL,
+                                     headers={"Authorization": authh})
+            self._check_handshake_status(r.status_code)
+            self._check_auth_result(self._decode(r.text))
+            self._auth_generation += 1
+            if self._session_store is not None:
+                self._session_store.save(self.INIT_URL, self._device_id,
+                                         iid, self._transport.get_cookies())
+
+    def _query(self, adapter, procedure, parameters):
+        '''Esegue una chiamata a una procedura del backend, usando la
+        cache se è configurata.
+        '''
+        ttl = self._cache_ttl.get(adapter) if self.cache is not None else None
+        if not ttl:
+            return self._post_query(adapter, procedure, parameters)
+        # Il device id è diverso per ogni sessione: lo escludo dalla
+        # chiave in modo che la cache possa essere condivisa
+        key = "{}/{}/{}".format(adapter, procedure,
+                                parameters.replace(self._device_id, ""))
+        metrics = self.metrics
+        result = self.cache.get(key)
+        if result is not None:
+            if metrics is not None:
+                metrics.increment("cache", adapter, procedure, result="hit")
+            return result
+        if metrics is not None:
+            metrics.increment("cache", adapter, procedure, result="miss")
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.cache._count("coalesced")
+            if metrics is not None:
+                metrics.increment("cache", adapter, procedure,
+                                  result="coalesced")
+            return future.result()
+        try:
+            result = self._post_query(adapter, procedure, parameters)
+            # Le risposte di errore non vengono salvate
+            if result.get("statusCode", 200) == 200:
+                self.cache.set(key, result, ttl)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _post_query(self, adapter, procedure, parameters):
+        '''Esegue una chiamata a una procedura del backend attraverso lo
+        scheduler, che ne regola la frequenza e la ripete in caso di
+        errori temporanei.
+        '''
+        if self._auth_generation == 0:
+            self._open_session()
+        return self.scheduler.call(adapter, functools.partial(
+            self._send_query, adapter, procedure, parameters))
+
+    def _send_query(self, adapter, procedure, parameters):
+        '''Invia una richiesta, ripetendo l'autenticazione se la sessione
+        è scaduta.
+        '''
+        metrics = self.metrics
+        data = (_form_prefix(adapter, procedure) +
+                quote_plus(parameters)).encode("ascii")
+        for i in range(2):
+            generation = self._auth_generation
+            if metrics is not None:
+                start = time.perf_counter()
+            try:
+                r = self._transport.post(self.QUERY_URL, data=data,
+                                         headers=_FORM_HEADERS)
+            except requests.RequestException as e:
+                if metrics is not None:
+                    metrics.increment("errors", adapter, procedure,
+                                      reason=type(e).__name__)
+                raise
+            if r.status_code in self.RETRY_STATUS:
+                self._unavailable(adapter, procedure, r.status_code)
+            if metrics is None:
+                result = self._decode(r.text)
             else:
-                act_arr = None
-            if stop["ActualInfo"]["Track"] != "":
-                sch_plat = stop["ActualInfo"]["Track"]
+                received = time.perf_counter()
+                text = r.text
+                converted = time.perf_counter()
+                result = self._decode(text)
+                decoded = time.perf_counter()
+                metrics.observe(adapter, procedure, "network",
+                                received - start)
+                metrics.observe(adapter, procedure, "charset",
+                                converted - received)
+                metrics.observe(adapter, procedure, "decode",
+                                decoded - converted)
+                metrics.increment("received_bytes", adapter, procedure,
+                                  _wire_bytes(r))
+            if r.status_code == 200:
+                if (metrics is not None and
+                        result.get("statusCode", 200) != 200):
+                    metrics.increment("errors", adapter, procedure,
+                                      reason=result.get("statusReason"))
+                return result
+            self._check_auth_status(adapter, procedure, r.status_code, i)
+            if metrics is not None:
+                metrics.increment("reauth", adapter, procedure)
+            self._authenticate(self._challenge(r.status_code, result),
+                               generation)
+
+    def search_station(self, name, only_italian=False):
+        p = self._station_params(name, only_italian)
+        result = self._query("StationsAdapter", "GetStations",
+                             self._dump_params(p))
+        return self._build("StationsAdapter", "GetStations",
+                           self._parse_stations, result)
+
+    def _fetch_solutions(self, parameters):
+        return self._parse_solution_page(
+            self._query("SearchAndBuyAdapter", "SearchTravels", parameters))
+
+    def search_solution(self, origin, destination, dep_date, arr_date=None,
+                        adults=1, children=0, train_type="All",
+                        max_changes=99, limit=10, page_size=5,
+                        prefetch=False):
+        '''Ricerca delle soluzioni di viaggio. Le soluzioni vengono
+        richieste al server a blocchi di page_size; con prefetch=True il
+        blocco successivo viene scaricato in background mentre il
+        chiamante consuma quello corrente.
+        '''
+        if page_size < 1:
+            raise ValueError("page_size must be a positive integer")
+        p = self._solution_params(origin, destination, dep_date, arr_date,
+                                  adults, children, train_type, max_changes)
+        pages = self._solution_pages(p, limit, page_size, prefetch)
+        try:
+            for page in pages:
+                for solution in page:
+                    yield self._build("SearchAndBuyAdapter", "SearchTravels",
+                                      self._parse_solution, solution)
+        finally:
+            pages.close()
+
+    def _solution_pages(self, p, limit, page_size, prefetch=False):
+        '''Generatore delle pagine di soluzioni grezze (al massimo limit
+        in totale) per i parametri di ricerca p. Con prefetch=True la
+        pagina successiva viene scaricata in background mentre il
+        chiamante elabora quella corrente.
+        '''
+        def fetch(start):
+            end = min(start + page_size, limit) - 1
+            page = self._fetch_solutions(self._page_params(p, start, end))
+            return start, end, page
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            cur_index = 0
+            pending = None
+            while cur_index < limit:
+                if pending is not None:
+                    start, end, page = pending.result()
+                else:
+                    start, end, page = fetch(cur_index)
+                pending = None
+                if page is None:
+                    return
+                cur_index = end + 1
+                if (executor is not None and cur_index < limit and
+                        len(page) > end - start):
+                    pending = executor.submit(fetch, cur_index)
+                yield page
+                # Il server ha restituito meno soluzioni di quelle
+                # richieste: non ce ne sono altre
+                if len(page) <= end - start:
+                    return
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def train_info(self, number, dep_st=None, arr_st=None, dep_date=None,
+                   lazy=False):
+        '''Info su un treno in tempo reale. Con lazy=True le fermate
+        vengono restituite come LazyStops e decodificate solo quando
+        vengono lette.
+        '''
+        p = self._train_params(number, dep_st, arr_st, dep_date)
+        result = self._query("TrainRealtimeInfoAdapter", "TrainRealtimeInfo",
+                             self._dump_params(p))
+        info = self._build("TrainRealtimeInfoAdapter", "TrainRealtimeInfo",
+                           self._parse_train_info, result, lazy)
+        if self.recorder is not None:
+            self._record("record_train_info", info)
+        return info
+
+    def train_info_many(self, queries, workers=8):
+        '''Esegue train_info per ogni elemento di queries, una tupla
+        (number, dep_st, arr_st, dep_date) di cui solo il primo elemento
+        è obbligatorio (oppure direttamente il numero del treno). Le
+        richieste vengono eseguite in parallelo su al massimo workers
+        thread che condividono la sessione. Restituisce un generatore di
+        coppie (query, risultato) nell'ordine in cui le richieste vengono
+        completate; se il treno non viene trovato, è cancellato o è
+        ambiguo, oppure se la query non è valida, il risultato è
+        l'eccezione corrispondente.
+        '''
+        if workers < 1:
+            raise ValueError("workers must be a positive integer")
+        self._resize_pool(workers)
+        handled = (self.TrainNotFound, self.TrainCancelled,
+                   self.MultipleTrainsFound, TypeError, ValueError)
+
+        def run(query):
+            if not isinstance(query, (tuple, list)):
+                query = (query,)
+            try:
+                return self.train_info(*query)
+            except handled as e:
+                return e
+
+        return _imap_unordered(run, queries, workers)
+
+    def timetable(self, station_id, ttype):
+        return self._timetable(station_id, ttype)
+
+    def _timetable(self, station_id, ttype, parse_row=None):
+        '''Legge un tabellone decodificando ogni riga con parse_row (di
+        default _parse_timetable_row); BoardMonitor lo usa per non
+        decodificare di nuovo le righe invariate.
+        '''
+        p = self._timetable_params(station_id, ttype)
+        result = self._query("GetStationTimetables", "getStationTables",
+                             self._dump_params(p))
+        trains = self._build("GetStationTimetables", "getStationTables",
+                             self._parse_timetable, result, parse_row)
+        if self.recorder is not None:
+            self._record("record_timetable", station_id, trains)
+        return trains
+
+
+class _PooledSession():
+    '''Stato di una sessione di SessionPool'''
+    __slots__ = ("backend", "outstanding", "requests", "errors", "results",
+                 "healthy")
+
+    def __init__(self, backend, window):
+        self.backend = backend
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        # Esiti (True = errore) delle ultime window richieste
+        self.results = deque(maxlen=window)
+        self.healthy = True
+
+    def error_rate(self):
+        if not self.results:
+            return 0.0
+        return sum(self.results) / len(self.results)
+
+
+class SessionPool(TrenitaliaBackend):
+    '''Insieme di size sessioni autenticate separatamente, ognuna con il
+    proprio device id e WL-Instance-Id, che espone gli stessi metodi di
+    TrenitaliaBackend. Ogni richiesta viene inviata alla sessione con
+    meno richieste in corso (routing="least_outstanding") oppure a turno
+    (routing="round_robin"). Una sessione viene considerata non
+    funzionante se la sua autenticazione fallisce o se la frazione di
+    errori di autenticazione o di protocollo nelle ultime window richieste
+    supera max_error_rate: smette di ricevere richieste e viene
+    autenticata di nuovo in background, senza bloccare le altre. Gli
+    errori temporanei del server (es. 503) non dipendono dalla sessione e
+    non vengono contati. Le sessioni vengono create con factory (di
+    default TrenitaliaBackend), a cui vengono passati gli altri argomenti;
+    cache, metriche e scheduler sono condivisi da tutto il pool, in modo
+    che i limiti di frequenza valgano per il pool nel suo insieme.
+    '''
+    ROUTING = ("least_outstanding", "round_robin")
+    # Numero minimo di richieste prima di valutare la frazione di errori
+    MIN_SAMPLES = 5
+    # Attesa massima tra due tentativi di autenticazione in background
+    MAX_REAUTH_DELAY = 60
+
+    def __init__(self, size=4, routing="least_outstanding", factory=None,
+                 window=20, max_error_rate=0.5, lazy=False, cache=None,
+                 cache_ttl=None, records=False, metrics=None, recorder=None,
+                 scheduler=None, **kwargs):
+        if size < 1:
+            raise ValueError("size must be a positive integer")
+        if routing not in self.ROUTING:
+            raise ValueError("routing must be one of {}".format(
+                ", ".join(self.ROUTING)))
+        if "transport" in kwargs:
+            # Il trasporto conserva cookie e intestazioni della sessione
+            raise ValueError("Sessions cannot share a transport, use "
+                             "factory to create one for each session")
+        if "session_store" in kwargs:
+            # Tutte le sessioni riprenderebbero la stessa identità
+            raise ValueError("Sessions cannot share a session store, use "
+                             "factory to create one for each session")
+        self._setup(records, metrics, recorder, scheduler, cache, cache_ttl)
+        # I parametri vengono costruiti con questo device id, che viene
+        # sostituito con quello della sessione scelta
+        self._device_id = str(uuid.uuid4())
+        self._routing = routing
+        self._max_error_rate = max_error_rate
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._closed = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        factory = factory or TrenitaliaBackend
+        self.sessions = [
+            _PooledSession(factory(lazy=True, records=records,
+                                   metrics=metrics, scheduler=self.scheduler,
+                                   **kwargs), window)
+            for _ in range(size)]
+        if not lazy:
+            # Le sessioni vengono autenticate in parallelo
+            futures = [self._executor.submit(s.backend._open_session)
+                       for s in self.sessions]
+            for future in futures:
+                future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        '''Interrompe le autenticazioni in background e chiude le
+        sessioni
+        '''
+        self._closed.set()
+        self._executor.shutdown(wait=False)
+        for s in self.sessions:
+            s.backend.close()
+
+    @property
+    def stats(self):
+        '''Stato di ogni sessione del pool'''
+        with self._lock:
+            return [{"device_id": s.backend._device_id,
+                     "healthy": s.healthy,
+                     "outstanding": s.outstanding,
+                     "requests": s.requests,
+                     "errors": s.errors,
+                     "error_rate": s.error_rate()}
+                    for s in self.sessions]
+
+    def _resize_pool(self, size):
+        # Le richieste vengono distribuite tra le sessioni
+        per_session = -(-size // len(self.sessions))
+        for s in self.sessions:
+            s.backend._resize_pool(per_session)
+
+    def _acquire(self):
+        '''Sceglie la sessione a cui inviare una richiesta'''
+        with self._lock:
+            candidates = [s for s in self.sessions if s.healthy]
+            # Se nessuna sessione funziona provo comunque con tutte
+            if not candidates:
+                candidates = self.sessions
+            turn = next(self._turn) % len(candidates)
+            if self._routing == "round_robin":
+                session = candidates[turn]
             else:
-                sch_plat = None
-            if stop["ActualInfo"]["Track"] != "":
-                act_plat = stop["ActualInfo"]["Track"]
+                # A parità di richieste in corso le sessioni vengono
+                # scelte a turno
+                candidates = candidates[turn:] + candidates[:turn]
+                session = min(candidates, key=lambda s: s.outstanding)
+            session.outstanding += 1
+            session.requests += 1
+            return session
+
+    def _release(self, session, error=None):
+        with self._lock:
+            session.outstanding -= 1
+            session.results.append(error is not None)
+            if error is None:
+                return
+            session.errors += 1
+            if not session.healthy:
+                return
+            if (isinstance(error, self.AuthenticationError) or
+                    (len(session.results) >= self.MIN_SAMPLES and
+                     session.error_rate() > self._max_error_rate)):
+                session.healthy = False
             else:
-                act_plat = None
-            stopdata = {"reached": stop["Reached"],
-                        "type": self._parse_stop_type(stop["StopType"]),
-                        "station": {"id": stop["Station"]["Id"],
-                                    "lat": stop["Station"]["Latitude"],
-                                    "lon": stop["Station"]["Longitude"],
-                                    "name": stop["Station"]["Name"]},
-                        "scheduled_dep": sch_dep,
-                        "actual_dep": act_dep,
-                        "scheduled_arr": sch_arr,
-                        "actual_arr": act_arr,
-                        "scheduled_plat": sch_plat,
-                        "actual_plat": act_plat}
-            output["stops"].append(stopdata)
-        return output
+                return
+        if not self._closed.is_set():
+            self._executor.submit(self._reauthenticate, session)
 
-    def timetable(self, station_id, ttype):
-        p = [{"AppVersion": self.VERSION_SHORT,
-              "Credentials": None,
-              "CredentialsAlias": None,
-              "DeviceId": self._device_id,
-              "Language": "IT",
-              "PlantId": "android",
-              "PointOfSaleId": 3,
-              "UnitOfWork": 0,
-              "StationId": station_id,
-              "Type": ttype.upper()},
-              None]
+    def _reauthenticate(self, session):
+        '''Autentica di nuovo una sessione non funzionante, riprovando con
+        attese crescenti finché non ci riesce
+        '''
+        delay = 1
+        while not self._closed.is_set():
+            backend = session.backend
+            try:
+                backend._authenticate(generation=backend._auth_generation)
+            except (requests.RequestException, self.AuthenticationError,
+                    self.InvalidServerResponse, self.ServiceUnavailable,
+                    ValueError):
+                self._closed.wait(delay)
+                delay = min(delay * 2, self.MAX_REAUTH_DELAY)
+                continue
+            with self._lock:
+                session.results.clear()
+                session.healthy = True
+            return
+
+    def _post_query(self, adapter, procedure, parameters):
+        session = self._acquire()
+        backend = session.backend
+        try:
+            result = backend._post_query(
+                adapter, procedure,
+                parameters.replace(self._device_id, backend._device_id))
+        except (self.AuthenticationError, self.InvalidServerResponse) as e:
+            # Solo gli errori di autenticazione e di protocollo dipendono
+            # dalla sessione: gli errori di rete e del server (503,
+            # circuito aperto) la riguardano come tutte le altre
+            self._release(session, e)
+            raise
+        except BaseException:
+            self._release(session)
+            raise
+        self._release(session)
+        return result
+
+
+class AsyncTrenitaliaBackend(_TrenitaliaBase):
+    '''Versione asincrona di TrenitaliaBackend, basata su aiohttp. Tutte
+    le richieste condividono un unico pool di connessioni; l'autenticazione
+    avviene alla prima richiesta (oppure entrando nel blocco async with).
+    '''
+
+    def __init__(self, connections=100, session_store=None, records=False,
+                 metrics=None, scheduler=None, recorder=None):
+        if aiohttp is None:
+            raise ImportError("AsyncTrenitaliaBackend requires aiohttp")
+        self._records = records
+        self.metrics = metrics
+        self.recorder = recorder
+        self.scheduler = scheduler or RequestScheduler()
+        self._connections = connections
+        self._session = None
+        self._headers = {"x-wl-app-version": self.VERSION}
+        self._session_store = session_store
+        self._auth_lock = None
+        # Viene incrementato a ogni autenticazione riuscita, in modo che
+        # le coroutine che ricevono un 401 contemporaneamente ne eseguano
+        # una sola
+        self._auth_generation = 0
+        if session_store is not None:
+            self._saved = session_store.load(self.INIT_URL)
+        else:
+            self._saved = None
+        if self._saved is not None:
+            self._device_id = self._saved["device_id"]
+            self._headers["WL-Instance-Id"] = self._saved["instance_id"]
+            self._auth_generation = 1
+        else:
+            # Genero un UUID univoco che identificherà questa sessione
+            self._device_id = str(uuid.uuid4())
+
+    async def __aenter__(self):
+        await self._ensure_authenticated()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, url, data=None, headers=None):
+        status, body, encoding, _ = await self._post_raw(url, data, headers)
+        return status, body.decode(encoding)
+
+    async def _post_raw(self, url, data=None, headers=None):
+        '''Invia una richiesta e restituisce il codice della risposta, il
+        corpo non convertito in testo, la sua codifica e i byte ricevuti
+        dalla rete (prima della decompressione)
+        '''
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._connections)
+            # unsafe=True permette di conservare i cookie anche quando
+            # l'host è un indirizzo IP
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                cookie_jar=aiohttp.CookieJar(unsafe=True))
+            if self._saved is not None:
+                cookies = SimpleCookie()
+                for c in self._saved["cookies"]:
+                    cookies[c["name"]] = c["value"]
+                    cookies[c["name"]]["domain"] = c["domain"]
+                    cookies[c["name"]]["path"] = c["path"]
+                self._session.cookie_jar.update_cookies(
+                    cookies, response_url=yarl.URL(self.INIT_URL))
+                self._saved = None
+        h = dict(self._headers)
+        if headers is not None:
+            h.update(headers)
+        async with self._session.post(url, data=data, headers=h) as r:
+            body = await r.read()
+            length = r.headers.get("Content-Length")
+            return (r.status, body, r.get_encoding(),
+                    int(length) if length else len(body))
+
+    async def _authenticate(self, authd=None, generation=None):
+        '''Esegue l'autenticazione. Se generation non corrisponde più a
+        quella corrente un'altra coroutine si è già autenticata nel
+        frattempo e non è necessario fare nulla.
+        '''
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        async with self._auth_lock:
+            if (generation is not None and
+                    generation != self._auth_generation):
+                return
+            if authd is None:
+                status, text = await self._post(self.INIT_URL)
+                if status in self.RETRY_STATUS:
+                    raise self.ServiceUnavailable("Server returned status "
+                                                  "code {}".format(status))
+                if (status != 401):
+                    raise self.InvalidServerResponse("Unexpected response "
+                                                     "from server while "
+                                                     "starting new session")
+                authd = self._decode(text)
+            iid, authh = self._auth_header(authd)
+            self._headers["WL-Instance-Id"] = iid
+            status, text = await self._post(self.INIT_URL,
+                                            headers={"Authorization": authh})
+            self._check_handshake_status(status)
+            self._check_auth_result(self._decode(text))
+            self._auth_generation += 1
+            if self._session_store is not None:
+                cookies = [{"name": m.key, "value": m.value,
+                            "domain": m["domain"], "path": m["path"]}
+                           for m in self._session.cookie_jar]
+                self._session_store.save(self.INIT_URL, self._device_id,
+                                         iid, cookies)
+
+    async def _ensure_authenticated(self):
+        if self._auth_generation == 0:
+            await self.scheduler.call_async(
+                self.INIT_ADAPTER,
+                functools.partial(self._authenticate, generation=0))
+
+    async def _query(self, adapter, procedure, parameters):
+        await self._ensure_authenticated()
+        return await self.scheduler.call_async(adapter, functools.partial(
+            self._send_query, adapter, procedure, parameters))
+
+    async def _send_query(self, adapter, procedure, parameters):
+        metrics = self.metrics
         for i in range(2):
-            r = self._session.post(self.QUERY_URL,
-                                   data={"adapter": "GetStationTimetables",
-                                         "procedure": "getStationTables",
-                                         "parameters": json.dumps(p)})
-            result = json.loads(self._cleanup(r.text))
-            if r.status_code == 200:
+            generation = self._auth_generation
+            if metrics is not None:
+                start = time.perf_counter()
+            status, body, encoding, wire = await self._post_raw(
+                self.QUERY_URL, data={"adapter": adapter,
+                                      "procedure": procedure,
+                                      "parameters": parameters})
+            if status in self.RETRY_STATUS:
+                self._unavailable(adapter, procedure, status)
+            if metrics is None:
+                result = self._decode(body.decode(encoding))
+            else:
+                received = time.perf_counter()
+                text = body.decode(encoding)
+                converted = time.perf_counter()
+                result = self._decode(text)
+                decoded = time.perf_counter()
+                metrics.observe(adapter, procedure, "network",
+                                received - start)
+                metrics.observe(adapter, procedure, "charset",
+                                converted - received)
+                metrics.observe(adapter, procedure, "decode",
+                                decoded - converted)
+                metrics.increment("received_bytes", adapter, procedure,
+                                  wire)
+            if status == 200:
+                if (metrics is not None and
+                        result.get("statusCode", 200) != 200):
+                    metrics.increment("errors", adapter, procedure,
+                                      reason=result.get("statusReason"))
+                return result
+            self._check_auth_status(adapter, procedure, status, i)
+            if metrics is not None:
+                metrics.increment("reauth", adapter, procedure)
+            await self._authenticate(self._challenge(status, result),
+                                     generation)
+
+    async def search_station(self, name, only_italian=False):
+        p = self._station_params(name, only_italian)
+        result = await self._query("StationsAdapter", "GetStations",
+                                   self._dump_params(p))
+        return self._build("StationsAdapter", "GetStations",
+                           self._parse_stations, result)
+
+    async def _fetch_solutions(self, parameters):
+        return self._parse_solution_page(
+            await self._query("SearchAndBuyAdapter", "SearchTravels",
+                              parameters))
+
+    async def search_solution(self, origin, destination, dep_date,
+                              arr_date=None, adults=1, children=0,
+                              train_type="All", max_changes=99, limit=10,
+                              page_size=5, prefetch=False):
+        '''Generatore asincrono delle soluzioni di viaggio, con la stessa
+        paginazione di TrenitaliaBackend.search_solution
+        '''
+        if page_size < 1:
+            raise ValueError("page_size must be a positive integer")
+        p = self._solution_params(origin, destination, dep_date, arr_date,
+                                  adults, children, train_type, max_changes)
+        pages = self._solution_pages(p, limit, page_size, prefetch)
+        try:
+            async for page in pages:
+                for solution in page:
+                    yield self._build("SearchAndBuyAdapter", "SearchTravels",
+                                      self._parse_solution, solution)
+        finally:
+            await pages.aclose()
+
+    async def _solution_pages(self, p, limit, page_size, prefetch=False):
+        '''Generatore asincrono delle pagine di soluzioni grezze, come
+        TrenitaliaBackend._solution_pages
+        '''
+        async def fetch(start):
+            end = min(start + page_size, limit) - 1
+            page = await self._fetch_solutions(
+                self._page_params(p, start, end))
+            return start, end, page
+
+        cur_index = 0
+        pending = None
+        try:
+            while cur_index < limit:
+                if pending is not None:
+                    start, end, page = await pending
+                else:
+                    start, end, page = await fetch(cur_index)
+                pending = None
+                if page is None:
+                    return
+                cur_index = end + 1
+                if (prefetch and cur_index < limit and
+                        len(page) > end - start):
+                    pending = asyncio.ensure_future(fetch(cur_index))
+                yield page
+                if len(page) <= end - start:
+                    return
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def train_info(self, number, dep_st=None, arr_st=None,
+                         dep_date=None, lazy=False):
+        p = self._train_params(number, dep_st, arr_st, dep_date)
+        result = await self._query("TrainRealtimeInfoAdapter",
+                                   "TrainRealtimeInfo",
+                                   self._dump_params(p))
+        info = self._build("TrainRealtimeInfoAdapter", "TrainRealtimeInfo",
+                           self._parse_train_info, result, lazy)
+        if self.recorder is not None:
+            # Il recorder scrive su file: non blocco il ciclo di eventi
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._record, "record_train_info", info)
+        return info
+
+    async def timetable(self, station_id, ttype):
+        p = self._timetable_params(station_id, ttype)
+        result = await self._query("GetStationTimetables", "getStationTables",
+                                   self._dump_params(p))
+        trains = self._build("GetStationTimetables", "getStationTables",
+                             self._parse_timetable, result)
+        if self.recorder is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._record, "record_timetable", station_id, trains)
+        return trains
+
+
+class StationCatalog():
+    '''Catalogo locale delle stazioni. Viene popolato con i risultati di
+    search_station e può essere salvato su disco; le ricerche per nome
+    (per prefisso, senza distinzione di accenti e approssimate) e per
+    posizione vengono eseguite su indici in memoria, interrogando il
+    backend solo se il catalogo non contiene risultati.
+    '''
+    CELL_SIZE = 0.25  # Lato in gradi delle celle dell'indice spaziale
+    EARTH_RADIUS = 6371.0  # km
+
+    def __init__(self, path=None, backend=None, autosave=True):
+        self.path = path
+        self.backend = backend
+        self.autosave = autosave
+        self._lock = threading.Lock()
+        self._stations = {}
+        # Lista ordinata di coppie (chiave normalizzata, id): per ogni
+        # stazione c'è una chiave per ogni parola del nome, in modo che
+        # "centrale" trovi anche "MILANO CENTRALE"
+        self._keys = []
+        # Nome normalizzato -> id delle stazioni, per la ricerca
+        # approssimata
+        self._names = {}
+        # Coppie (nome normalizzato, only_italian) già cercate sul server
+        self._searched = set()
+        self._grid = {}
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._stations)
+
+    def __contains__(self, station_id):
+        return station_id in self._stations
+
+    def __getitem__(self, station_id):
+        return self._stations[station_id]
+
+    @staticmethod
+    def _normalize(name):
+        '''Rimuove accenti, punteggiatura e maiuscole da un nome'''
+        name = unicodedata.normalize("NFKD", name)
+        name = "".join(c if c.isalnum() else " " for c in name
+                       if not unicodedata.combining(c))
+        return " ".join(name.lower().split())
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.CELL_SIZE),
+                math.floor(lon / self.CELL_SIZE))
+
+    def _distance(self, lat1, lon1, lat2, lon2):
+        '''Distanza in km tra due punti (formula dell'emisenoverso)'''
+        lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+        a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) *
+             math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+        return 2 * self.EARTH_RADIUS * math.asin(math.sqrt(a))
+
+    def _remove(self, station_id):
+        old = self._stations.pop(station_id)
+        normalized = self._normalize(old["name"])
+        self._names[normalized].remove(station_id)
+        if not self._names[normalized]:
+            del self._names[normalized]
+        words = normalized.split()
+        for i in range(len(words)):
+            entry = (" ".join(words[i:]), station_id)
+            pos = bisect.bisect_left(self._keys, entry)
+            if pos < len(self._keys) and self._keys[pos] == entry:
+                del self._keys[pos]
+        if old["lat"] is not None and old["lon"] is not None:
+            cell = self._cell(float(old["lat"]), float(old["lon"]))
+            self._grid[cell].remove(station_id)
+            if not self._grid[cell]:
+                del self._grid[cell]
+
+    def update(self, stations):
+        '''Aggiunge al catalogo (o aggiorna) una lista di stazioni nel
+        formato restituito da search_station
+        '''
+        with self._lock:
+            for station in stations:
+                if station["id"] in self._stations:
+                    if self._stations[station["id"]] == station:
+                        continue
+                    self._remove(station["id"])
+                self._stations[station["id"]] = station
+                normalized = self._normalize(station["name"])
+                self._names.setdefault(normalized, []).append(station["id"])
+                words = normalized.split()
+                for i in range(len(words)):
+                    bisect.insort(self._keys,
+                                  (" ".join(words[i:]), station["id"]))
+                if station["lat"] is not None and station["lon"] is not None:
+                    cell = self._cell(float(station["lat"]),
+                                      float(station["lon"]))
+                    self._grid.setdefault(cell, []).append(station["id"])
+
+    def load(self, path=None):
+        '''Carica il catalogo da un file creato con save'''
+        stations = []
+        with gzip.open(path or self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#"):
+                    # Nome già cercato sul server
+                    _, only_italian, key = line.rstrip("\n").split("\t")
+                    self._searched.add((key, only_italian == "1"))
+                    continue
+                sid, railway, lat, lon, name = line.rstrip("\n").split("\t")
+                stations.append({"name": name,
+                                 "lon": Decimal(lon) if lon else None,
+                                 "lat": Decimal(lat) if lat else None,
+                                 "id": int(sid),
+                                 "railway": int(railway)})
+        self.update(stations)
+
+    def save(self, path=None):
+        '''Salva il catalogo su disco come file di testo compresso, con
+        una stazione per riga, seguite dai nomi già cercati sul server
+        '''
+        path = path or self.path
+        tmp = path + ".tmp"
+        with self._lock, gzip.open(tmp, "wt", encoding="utf-8") as f:
+            for s in self._stations.values():
+                f.write("{}\t{}\t{}\t{}\t{}\n".format(
+                    s["id"], s["railway"],
+                    "" if s["lat"] is None else s["lat"],
+                    "" if s["lon"] is None else s["lon"],
+                    s["name"]))
+            for key, only_italian in sorted(self._searched):
+                f.write("#\t{}\t{}\n".format(int(only_italian), key))
+        os.replace(tmp, path)
+
+    def prefix(self, name, limit=10):
+        '''Stazioni con una parola del nome che inizia con name'''
+        key = self._normalize(name)
+        found = []
+        if not key:
+            return found
+        pos = bisect.bisect_left(self._keys, (key,))
+        while pos < len(self._keys) and len(found) < limit:
+            k, sid = self._keys[pos]
+            if not k.startswith(key):
                 break
-            if i > 0:
-                raise self.AuthenticationError("Authentication attempt failed "
-                                               "after getting non 200 status "
-                                               "code")
-            self._authenticate(result)
-        output = []
-        for train in result["trains"]:
+            if sid not in found:
+                found.append(sid)
+            pos += 1
+        return [self._stations[sid] for sid in found]
+
+    def fuzzy(self, name, limit=10, cutoff=0.6):
+        '''Stazioni con il nome più simile a name'''
+        with self._lock:
+            names = list(self._names)
+        matches = difflib.get_close_matches(self._normalize(name), names,
+                                            n=limit, cutoff=cutoff)
+        with self._lock:
+            return [self._stations[sid] for m in matches
+                    for sid in self._names.get(m, ())][:limit]
+
+    def search(self, name, limit=10, only_italian=False):
+        '''Cerca una stazione per nome. Se nessuna stazione del catalogo
+        ha un nome che inizia con name e il catalogo è associato a un
+        backend, i risultati vengono richiesti al server (una sola volta
+        per ogni nome, anche tra esecuzioni diverse se il catalogo viene
+        salvato) e aggiunti al catalogo. Se non viene trovata nessuna
+        stazione viene eseguita una ricerca approssimata.
+        '''
+        output = self.prefix(name, limit)
+        if output:
+            return output
+        key = self._normalize(name)
+        if (self.backend is not None and
+                (key, only_italian) not in self._searched):
+            stations = self.backend.search_station(name, only_italian)
+            with self._lock:
+                self._searched.add((key, only_italian))
+            if stations:
+                self.update(stations)
+            if self.autosave and self.path is not None:
+                self.save()
+            output = self.prefix(name, limit) or stations[:limit]
+            if output:
+                return output
+        return self.fuzzy(name, limit)
+
+    def nearest(self, lat, lon, n=5):
+        '''Restituisce le n stazioni più vicine al punto (lat, lon) come
+        lista di coppie (distanza in km, stazione)
+        '''
+        lat, lon = float(lat), float(lon)
+        if not self._grid or n <= 0:
+            return []
+        clat, clon = self._cell(lat, lon)
+        lats = [c[0] for c in self._grid]
+        lons = [c[1] for c in self._grid]
+        max_ring = max(abs(clat - min(lats)), abs(clat - max(lats)),
+                       abs(clon - min(lons)), abs(clon - max(lons)))
+        found = []
+        ring = 0
+        while ring <= max_ring:
+            # Celle che si trovano esattamente a distanza ring dalla cella
+            # che contiene il punto
+            for i in range(clat - ring, clat + ring + 1):
+                for j in range(clon - ring, clon + ring + 1):
+                    if max(abs(i - clat), abs(j - clon)) != ring:
+                        continue
+                    for sid in self._grid.get((i, j), ()):
+                        s = self._stations[sid]
+                        found.append((self._distance(lat, lon,
+                                                     float(s["lat"]),
+                                                     float(s["lon"])), sid))
+            found.sort()
+            del found[n:]
+            # Tutte le stazioni nelle celle successive distano almeno
+            # ring celle dal punto: se le n trovate sono più vicine non
+            # serve proseguire
+            min_lat = min(89.0, abs(lat) + (ring + 1) * self.CELL_SIZE)
+            bound = (math.radians(ring * self.CELL_SIZE) * self.EARTH_RADIUS *
+                     math.cos(math.radians(min_lat)))
+            if len(found) == n and found[-1][0] <= bound:
+                break
+            ring += 1
+        return [(d, self._stations[sid]) for d, sid in found]
+
+
+
+class BoardMonitor():
+    '''Controlla periodicamente i tabelloni di un insieme di stazioni e
+    segnala solo le variazioni rispetto alla lettura precedente, come
+    dizionari con le chiavi "event", "station", "train" e "previous":
+    * new: un treno compare sul tabellone;
+    * delay: il ritardo del treno è cambiato;
+    * platform: il binario effettivo è cambiato;
+    * departed (o arrived per i tabelloni degli arrivi): il treno non è
+      più sul tabellone;
+    * error: la lettura del tabellone è fallita ("error" contiene
+      l'eccezione).
+    I treni sono identificati dalla coppia (categoria, numero) e le righe
+    identiche a quelle della lettura precedente non vengono decodificate.
+    L'intervallo tra due letture di una stazione si dimezza (fino a
+    min_interval) quando ci sono variazioni e aumenta (fino a
+    max_interval) quando non ce ne sono; durante le ore in quiet_hours
+    viene usato sempre max_interval.
+    '''
+
+    def __init__(self, backend, stations, ttype="departure",
+                 min_interval=30, max_interval=300, quiet_hours=range(1, 5),
+                 workers=4):
+        self.backend = backend
+        self.ttype = ttype
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.quiet_hours = quiet_hours
+        self.workers = workers
+        self.snapshots = {}
+        self.intervals = {}
+        self._stations = list(stations)
+        if ttype.lower().startswith("arr"):
+            self._gone = "arrived"
+        else:
+            self._gone = "departed"
+
+    def poll(self, station_id):
+        '''Legge il tabellone di una stazione e restituisce la lista delle
+        variazioni
+        '''
+        tb = self.backend
+        old = self.snapshots.get(station_id, {})
+        rows = []
+
+        def parse(raw):
+            key = (raw["category"]["code"], raw["number"])
+            previous = old.get(key)
+            if previous is not None and previous[0] == raw:
+                train = previous[1]
+            else:
+                train = tb._parse_timetable_row(raw)
+            rows.append((key, raw, train, previous))
+            return train
+
+        tb._timetable(station_id, self.ttype, parse)
+        new = {}
+        events = []
+        for key, raw, train, previous in rows:
+            new[key] = (raw, train)
+            if previous is not None and previous[1] is train:
+                continue
+            if previous is None:
+                events.append({"event": "new", "station": station_id,
+                               "train": train, "previous": None})
+                continue
+            before = previous[1]
+            for event, field in (("delay", "delay"),
+                                 ("platform", "actual_plat")):
+                if _field(train, field) != _field(before, field):
+                    events.append({"event": event, "station": station_id,
+                                   "train": train, "previous": before})
+        for key, (raw, train) in old.items():
+            if key not in new:
+                events.append({"event": self._gone, "station": station_id,
+                               "train": train, "previous": train})
+        self.snapshots[station_id] = new
+        return events
+
+    def _next_interval(self, station_id, changed):
+        if time.localtime().tm_hour in self.quiet_hours:
+            interval = self.max_interval
+        else:
+            interval = self.intervals.get(station_id, self.min_interval)
+            if changed:
+                interval = max(self.min_interval, interval / 2)
+            else:
+                interval = min(self.max_interval, interval * 1.5)
+        self.intervals[station_id] = interval
+        return interval
+
+    def _safe_poll(self, station_id):
+        try:
+            return self.poll(station_id)
+        except Exception as e:
+            return [{"event": "error", "station": station_id,
+                     "train": None, "previous": None, "error": e}]
+
+    def run(self, stop=None):
+        '''Generatore delle variazioni di tutte le stazioni. Le stazioni
+        da leggere nello stesso momento vengono lette in parallelo su
+        workers thread. Termina quando l'evento stop (threading.Event)
+        viene impostato.
+        '''
+        stop = stop or threading.Event()
+        # Coda delle prossime letture: (istante, stazione)
+        queue = [(0, i, s) for i, s in enumerate(self._stations)]
+        heapq.heapify(queue)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while queue and not stop.is_set():
+                delay = queue[0][0] - time.monotonic()
+                if delay > 0:
+                    stop.wait(delay)
+                    continue
+                due = []
+                while queue and queue[0][0] <= time.monotonic():
+                    due.append(heapq.heappop(queue))
+                polls = executor.map(self._safe_poll,
+                                     [s for _, _, s in due])
+                for (_, i, station_id), events in zip(due, polls):
+                    changed = any(e["event"] != "error" for e in events)
+                    if any(e["event"] == "error" for e in events):
+                        interval = self.max_interval
+                    else:
+                        interval = self._next_interval(station_id, changed)
+                    heapq.heappush(queue,
+                                   (time.monotonic() + interval, i,
+                                    station_id))
+                    for event in events:
+                        yield event
+
+
+class JourneyMatrix():
+    '''Ricerca delle soluzioni di viaggio per tutte le combinazioni di
+    origins, destinations e windows. Ogni finestra è una data di partenza
+    (vengono cercate le prime limit soluzioni successive) oppure una
+    coppia (inizio, fine) (vengono cercate le soluzioni in partenza
+    nell'intervallo, al massimo limit). Le combinazioni ripetute o con
+    origine uguale alla destinazione vengono scartate e le ricerche sono
+    eseguite in parallelo su al massimo workers thread. Le ricerche
+    completate vengono aggiunte al file checkpoint, se indicato, e non
+    vengono ripetute eseguendo di nuovo run (ad esempio dopo
+    un'interruzione). Gli altri argomenti vengono passati a
+    search_solution.
+    '''
+    COLUMNS = ("solution_id", "duration", "changes", "min_price",
+               "min_points", "vehicles")
+
+    def __init__(self, backend, origins, destinations, windows, limit=10,
+                 page_size=5, workers=8, checkpoint=None, adults=1,
+                 children=0, train_type="All", max_changes=99):
+        if workers < 1:
+            raise ValueError("workers must be a positive integer")
+        if page_size < 1:
+            raise ValueError("page_size must be a positive integer")
+        self.backend = backend
+        self.limit = limit
+        self.page_size = page_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self._options = (adults, children, train_type, max_changes)
+        # dict.fromkeys elimina i duplicati mantenendo l'ordine
+        self.queries = list(dict.fromkeys(
+            (str(o), str(d)) + self._window(w)
+            for o, d, w in itertools.product(origins, destinations, windows)
+            if str(o) != str(d)))
+
+    def _window(self, window):
+        '''Converte una finestra nella coppia (inizio, fine) di stringhe
+        nel formato usato dal backend
+        '''
+        if isinstance(window, (tuple, list)):
+            start, end = window
+        else:
+            start, end = window, None
+        build = self.backend._build_date
+        return build(start), build(end)
+
+    def _completed(self):
+        '''Ricerche già registrate nel file checkpoint'''
+        done = set()
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return done
+        with open(self.checkpoint, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(tuple(json.loads(line)))
+                except ValueError:
+                    # Riga troncata da un'interruzione durante la scrittura
+                    continue
+        return done
+
+    def _row(self, solution):
+        '''Valori delle colonne per una soluzione grezza, senza costruire
+        il dizionario completo
+        '''
+        nil = self.backend.NIL
+        price = solution["MinPrice"]
+        points = solution.get("MinLoyaltyPoints", nil)
+        vehicles = " ".join(
+            v["Train"]["CategoryCode"] + v["Train"]["Number"]
+            for v in self.backend._dict2list(
+                solution["Nodes"]["SolutionNode"]))
+        return (solution["SolutionId"],
+                int(_parse_duration(
+                    solution["TotalJourneyTime"]).total_seconds()),
+                int(solution["Changes"]),
+                None if price == nil else price,
+                None if points == nil else points,
+                vehicles)
+
+    def _search(self, query):
+        '''Esegue una ricerca e restituisce le colonne dei risultati'''
+        tb = self.backend
+        origin, destination, start, end = query
+        p = tb._solution_params(origin, destination, None, None,
+                                *self._options)
+        p[1]["SearchTravelsRequest"]["Body"]["DepartureDateTimeRange"] = {
+            "Start": start, "End": None}
+        if end is not None:
+            end = _parse_datetime(end)
+        columns = tuple([] for _ in self.COLUMNS)
+        pages = tb._solution_pages(p, self.limit, self.page_size)
+        try:
+            for solution in itertools.chain.from_iterable(pages):
+                if (end is not None and
+                        _parse_datetime(solution["DepartureDateTime"]) > end):
+                    # Le soluzioni successive sono fuori dalla finestra
+                    break
+                for column, value in zip(columns, self._row(solution)):
+                    column.append(value)
+        except tb.NoSolutionsFound:
+            pass
+        finally:
+            pages.close()
+        return dict(zip(self.COLUMNS, columns))
+
+    def _safe_search(self, query):
+        try:
+            return self._search(query)
+        except Exception as e:
+            return e
+
+    def run(self):
+        '''Generatore di coppie (query, colonne) nell'ordine in cui le
+        ricerche vengono completate, dove query è la tupla (origine,
+        destinazione, inizio, fine) e colonne un dizionario con una lista
+        di valori per ogni elemento di COLUMNS (durate in secondi, prezzi
+        e punti come stringhe, treni come codice della categoria e numero
+        separati da spazi). Se una ricerca fallisce al posto delle colonne
+        viene restituita l'eccezione e la ricerca non viene registrata nel
+        checkpoint.
+        '''
+        done = self._completed()
+        todo = [q for q in self.queries if q not in done]
+        self.backend._resize_pool(self.workers)
+        checkpoint = None
+        if self.checkpoint is not None:
+            checkpoint = open(self.checkpoint, "a", encoding="utf-8")
+        try:
+            for query, columns in _imap_unordered(self._safe_search, todo,
+                                                  self.workers):
+                yield query, columns
+                # La ricerca viene registrata solo dopo essere stata
+                # elaborata dal chiamante
+                if checkpoint is not None and isinstance(columns, dict):
+                    checkpoint.write(json.dumps(query) + "\n")
+                    checkpoint.flush()
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+    def write(self, f):
+        '''Scrive i risultati di run su f, una riga JSON per ricerca con
+        le chiavi origin, destination, start, end e le colonne (oppure
+        error). Restituisce il numero di ricerche completate.
+        '''
+        count = 0
+        for (origin, destination, start, end), columns in self.run():
+            line = {"origin": origin, "destination": destination,
+                    "start": start, "end": end}
+            if isinstance(columns, dict):
+                line.update(columns)
+                count += 1
+            else:
+                line["error"] = "{}: {}".format(type(columns).__name__,
+                                                columns)
+            f.write(json.dumps(line, separators=(",", ":")) + "\n")
+            f.flush()
+        return count
+
+
+class DelayStore():
+    '''Archivio dei ritardi osservati con train_info e timetable, su
+    disco nella cartella path. Ogni osservazione è una riga di interi a
+    64 bit (COLUMNS): istante della lettura, data del treno (AAAAMMGG),
+    numero del treno, stazione, tipo (KIND_STOP per una fermata letta con
+    train_info, KIND_BOARD per una riga di un tabellone), ritardo in
+    secondi, data dell'ultimo rilevamento e orari programmati ed
+    effettivi come timestamp Unix; MISSING indica un valore mancante.
+    Le righe vengono solo aggiunte, in segmenti di SEGMENT_ROWS righe con
+    un file per colonna, che vengono letti con mmap senza decodificare le
+    singole righe; le osservazioni identiche alla precedente per lo
+    stesso treno, data, stazione e tipo non vengono salvate (solo per
+    le RECENT_DATES date più recenti). Gli indici per treno, stazione e
+    data vengono ricostruiti in memoria all'apertura, che non modifica i
+    file: l'archivio può essere letto da altri processi anche mentre
+    viene scritto.
+    Le statistiche vengono calcolate con numpy se è installato.
+    '''
+    COLUMNS = ("time", "date", "train", "station", "kind", "delay",
+               "checkpoint", "scheduled_arr", "actual_arr", "scheduled_dep",
+               "actual_dep")
+    INDEXED = ("train", "station", "date")
+    KIND_STOP = 0
+    KIND_BOARD = 1
+    MISSING = -2 ** 63
+    SEGMENT_ROWS = 1 << 20
+    # Righe tenute in memoria prima di essere scritte su disco
+    BUFFER_ROWS = 4096
+    # Date dei treni per cui viene ricordata l'ultima osservazione
+    RECENT_DATES = 3
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._rows = 0
+        self._buffer = [array.array("q") for _ in self.COLUMNS]
+        self._files = None
+        self._maps = {}
+        self._index = {name: {} for name in self.INDEXED}
+        # Per ognuna delle date più recenti, ultima osservazione salvata
+        # per ogni (treno, stazione, tipo)
+        self._last = {}
+        self._load()
+
+    def __len__(self):
+        return self._rows + len(self._buffer[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _file(self, segment, column):
+        return os.path.join(self.path, "{:06d}.{}".format(segment, column))
+
+    def _load(self):
+        '''Ricostruisce gli indici leggendo le colonne dei segmenti'''
+        segment = 0
+        while os.path.exists(self._file(segment, self.COLUMNS[0])):
+            # Una scrittura interrotta (o in corso in un altro processo)
+            # può aver lasciato colonne di lunghezza diversa: considero
+            # solo le righe complete, senza modificare i file
+            size = min(os.path.getsize(self._file(segment, c))
+                       for c in self.COLUMNS) // 8
+            columns = [self._column(segment, c)[:size]
+                       for c in self.COLUMNS]
+            self._add(zip(*columns))
+            self._maps.clear()
+            if size < self.SEGMENT_ROWS:
+                break
+            segment += 1
+        self._load_recent()
+
+    def _load_recent(self):
+        '''Legge le ultime osservazioni delle date più recenti'''
+        dates = sorted(self._index["date"])[-self.RECENT_DATES:]
+        rows = array.array("q", sorted(itertools.chain.from_iterable(
+            self._index["date"][date] for date in dates)))
+        columns = [self._gather(c, rows) for c in self.COLUMNS]
+        if numpy is not None:
+            columns = [c.tolist() for c in columns]
+        for row in zip(*columns):
+            self._remember(row)
+
+    def _remember(self, row):
+        '''Registra l'ultima osservazione di un treno in una stazione,
+        se la data del treno è tra le RECENT_DATES più recenti
+        '''
+        date = row[1]
+        last = self._last.get(date)
+        if last is None:
+            if (len(self._last) >= self.RECENT_DATES and
+                    date < min(self._last)):
+                return
+            last = self._last[date] = {}
+            if len(self._last) > self.RECENT_DATES:
+                del self._last[min(self._last)]
+        last[row[2:5]] = row[5:]
+
+    def _add(self, rows):
+        '''Aggiorna gli indici con nuove righe'''
+        positions = [self.COLUMNS.index(name) for name in self.INDEXED]
+        for row in rows:
+            for name, i in zip(self.INDEXED, positions):
+                self._index[name].setdefault(
+                    row[i], array.array("q")).append(self._rows)
+            self._rows += 1
+
+    def _column(self, segment, column):
+        '''Colonna di un segmento come memoryview di interi, letta con
+        mmap
+        '''
+        key = (segment, column)
+        view = self._maps.get(key)
+        if view is None:
+            with open(self._file(segment, column), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"").cast("q")
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mm).cast("q")
+            # Solo i segmenti completi non cambiano più
+            if len(view) == self.SEGMENT_ROWS:
+                self._maps[key] = view
+        return view
+
+    @staticmethod
+    def _timestamp(date):
+        if date is None:
+            return DelayStore.MISSING
+        return int(date.timestamp())
+
+    @staticmethod
+    def _seconds(delta):
+        if delta is None:
+            return DelayStore.MISSING
+        return int(delta.total_seconds())
+
+    def append(self, row):
+        '''Aggiunge una riga (una tupla con un valore per ogni elemento
+        di COLUMNS). Restituisce False se è identica all'ultima
+        osservazione dello stesso treno nella stessa data e stazione (per
+        le date più recenti).
+        '''
+        with self._lock:
+            row = tuple(row)
+            if self._last.get(row[1], {}).get(row[2:5]) == row[5:]:
+                return False
+            for column, value in zip(self._buffer, row):
+                column.append(value)
+            self._remember(row)
+            if len(self._buffer[0]) >= self.BUFFER_ROWS:
+                self.flush()
+            return True
+
+    def flush(self):
+        '''Scrive su disco le righe in memoria'''
+        with self._lock:
+            buffered = self._buffer
+            count = len(buffered[0])
+            start = 0
+            while start < count:
+                segment, offset = divmod(self._rows, self.SEGMENT_ROWS)
+                n = min(count - start, self.SEGMENT_ROWS - offset)
+                for column, values in zip(self.COLUMNS, buffered):
+                    with open(self._file(segment, column), "ab") as f:
+                        # Elimino le righe incomplete lasciate da una
+                        # scrittura interrotta
+                        f.truncate(offset * 8)
+                        f.write(values[start:start + n].tobytes())
+                self._add(zip(*(values[start:start + n]
+                                for values in buffered)))
+                start += n
+            self._buffer = [array.array("q") for _ in self.COLUMNS]
+
+    def close(self):
+        self.flush()
+        self._maps.clear()
+
+    def _stop_times(self, stop):
+        '''Stazione e orari di una fermata: arrivo programmato ed
+        effettivo, partenza programmata ed effettiva
+        '''
+        return (_field(_field(stop, "station"), "id"),
+                _field(stop, "scheduled_arr"), _field(stop, "actual_arr"),
+                _field(stop, "scheduled_dep"), _field(stop, "actual_dep"))
+
+    def _lazy_stop_times(self, stops):
+        '''Come _stop_times per ogni fermata di LazyStops, leggendo i
+        dati grezzi: le fermate restano da decodificare per il chiamante
+        '''
+        parse = stops._backend._parse_date
+        nil = _TrenitaliaBase.NIL
+        for stop in stops._raw:
+            times = [stop["Station"]["Id"]]
+            for info, name in (("ScheduledInfo", "Arrival"),
+                               ("ActualInfo", "Arrival"),
+                               ("ScheduledInfo", "Departure"),
+                               ("ActualInfo", "Departure")):
+                value = stop[info][name]
+                times.append(parse(value) if value != nil else None)
+            yield tuple(times)
+
+    def record_train_info(self, info, observed=None):
+        '''Salva una riga per ogni fermata di un risultato di
+        train_info. Il ritardo di una fermata è la differenza tra l'orario
+        effettivo e quello programmato (della partenza oppure, se manca,
+        dell'arrivo). Le fermate che non si possono salvare (codice della
+        stazione non numerico) vengono saltate. Restituisce il numero di
+        righe salvate.
+        '''
+        observed = int(observed if observed is not None else time.time())
+        stops = _field(info, "stops")
+        if isinstance(stops, LazyStops):
+            stops = list(self._lazy_stop_times(stops))
+        else:
+            stops = [self._stop_times(stop) for stop in stops]
+        # La data del treno è quella del primo orario programmato
+        first = next((t for _, sch_arr, _, sch_dep, _ in stops
+                      for t in (sch_dep, sch_arr) if t is not None), None)
+        try:
+            train = int(_field(info, "number"))
+        except (TypeError, ValueError):
+            return 0
+        if first is None:
+            return 0
+        date = int(first.strftime("%Y%m%d"))
+        checkpoint = self._timestamp(_field(info, "checkpoint_date"))
+        count = 0
+        for station, sch_arr, act_arr, sch_dep, act_dep in stops:
             try:
-                chkpdate = self._parse_date(train["LastReachedCheckPointBase"])
-            except TypeError:
-                chkpdate = None
-            output.append({"category": (train["category"]["code"],
-                                        train["category"]["name"]),
-                           "number": train["number"],
-                           "delay": self._parse_time(train["delay"]),
-                           "checkpoint_date": chkpdate,
-                           "origin": {"id": train["originId"],
-                                      "name":  train["originName"]},
-                           "destination": {"id": train["destinationId"],
-                                           "name":  train["destinationName"]},
-                           "dep_time": train["departureTime"],
-                           "arr_time": train["arrivalTime"],
-                           "scheduled_plat": train["scheduledTrack"]
-                             if train["scheduledTrack"] != "" else None,
-                           "actual_plat": train["actualTrack"]
-                             if train["actualTrack"] != "" else None})
-        return output
+                station = int(station)
+            except (TypeError, ValueError):
+                continue
+            if sch_dep is not None and act_dep is not None:
+                delay = self._seconds(act_dep - sch_dep)
+            elif sch_arr is not None and act_arr is not None:
+                delay = self._seconds(act_arr - sch_arr)
+            else:
+                delay = self.MISSING
+            count += self.append((
+                observed, date, train, station, self.KIND_STOP, delay,
+                checkpoint, self._timestamp(sch_arr),
+                self._timestamp(act_arr), self._timestamp(sch_dep),
+                self._timestamp(act_dep)))
+        return count
+
+    def record_timetable(self, station_id, trains, observed=None):
+        '''Salva una riga per ogni treno di un tabellone di timetable,
+        con il ritardo del treno; i treni con un numero non numerico
+        (es. "FR 9612") vengono saltati. Restituisce il numero di righe
+        salvate.
+        '''
+        observed = int(observed if observed is not None else time.time())
+        today = int(time.strftime("%Y%m%d", time.localtime(observed)))
+        try:
+            station_id = int(station_id)
+        except (TypeError, ValueError):
+            return 0
+        count = 0
+        for train in trains:
+            try:
+                number = int(_field(train, "number"))
+            except (TypeError, ValueError):
+                continue
+            checkpoint = _field(train, "checkpoint_date")
+            date = (int(checkpoint.strftime("%Y%m%d"))
+                    if checkpoint is not None else today)
+            count += self.append((
+                observed, date, number, station_id, self.KIND_BOARD,
+                self._seconds(_field(train, "delay")),
+                self._timestamp(checkpoint), self.MISSING, self.MISSING,
+                self.MISSING, self.MISSING))
+        return count
+
+    def _select(self, train, station, start, end, kind):
+        '''Restituisce le righe che soddisfano i filtri, come dizionario
+        di colonne (array numpy se disponibile, altrimenti liste)
+        '''
+        with self._lock:
+            self.flush()
+            return self._filter(train, station, start, end, kind)
+
+    def _filter(self, train, station, start, end, kind):
+        filters = {"train": train, "station": station}
+        if start is not None and start == end:
+            filters["date"] = start
+        lists = [self._index[name].get(int(value), array.array("q"))
+                 for name, value in filters.items() if value is not None]
+        if lists:
+            rows = min(lists, key=len)
+        else:
+            rows = range(self._rows)
+        names = ("date", "train", "station", "kind", "delay")
+        columns = {name: self._gather(name, rows) for name in names}
+        # Filtri applicati a tutte le righe selezionate insieme
+        conditions = [columns["delay"] != self.MISSING
+                      if numpy is not None else
+                      [d != self.MISSING for d in columns["delay"]]]
+        for name, value, op in (("train", train, "eq"),
+                                ("station", station, "eq"),
+                                ("kind", kind, "eq"),
+                                ("date", start, "ge"),
+                                ("date", end, "le")):
+            if value is not None:
+                conditions.append(self._compare(columns[name], op,
+                                                int(value)))
+        if numpy is not None:
+            mask = numpy.logical_and.reduce(conditions)
+            return {name: values[mask] for name, values in columns.items()}
+        mask = [all(c) for c in zip(*conditions)]
+        return {name: list(itertools.compress(values, mask))
+                for name, values in columns.items()}
+
+    @staticmethod
+    def _compare(values, op, value):
+        if numpy is not None:
+            if op == "eq":
+                return values == value
+            return values >= value if op == "ge" else values <= value
+        if op == "eq":
+            return [v == value for v in values]
+        if op == "ge":
+            return [v >= value for v in values]
+        return [v <= value for v in values]
+
+    def _gather(self, column, rows):
+        '''Valori di una colonna per le righe indicate (in ordine
+        crescente)
+        '''
+        size = self.SEGMENT_ROWS
+        if numpy is not None:
+            if isinstance(rows, range):
+                rows = numpy.arange(rows.start, rows.stop, dtype=numpy.int64)
+            else:
+                rows = numpy.frombuffer(rows, dtype=numpy.int64)
+            parts = []
+            segments = rows // size
+            bounds = numpy.searchsorted(
+                segments, numpy.arange(self._rows // size + 2))
+            for segment in range(len(bounds) - 1):
+                first, last = bounds[segment], bounds[segment + 1]
+                if first == last:
+                    continue
+                values = numpy.frombuffer(self._column(segment, column),
+                                          dtype=numpy.int64)
+                parts.append(values[rows[first:last] - segment * size])
+            if not parts:
+                return numpy.zeros(0, dtype=numpy.int64)
+            return numpy.concatenate(parts)
+        values = []
+        segment, view = None, None
+        for row in rows:
+            if row // size != segment:
+                segment = row // size
+                view = self._column(segment, column)
+            values.append(view[row - segment * size])
+        return values
+
+    def delays(self, train=None, station=None, start=None, end=None,
+               kind=None):
+        '''Ritardi in secondi delle osservazioni che soddisfano i filtri
+        (start ed end sono date nel formato AAAAMMGG, incluse)
+        '''
+        return self._select(train, station, start, end, kind)["delay"]
+
+    def delay_stats(self, train=None, station=None, start=None, end=None,
+                    kind=None):
+        '''Numero di osservazioni, media, minimo, massimo, mediana e
+        novantesimo percentile del ritardo in secondi
+        '''
+        values = self.delays(train, station, start, end, kind)
+        if len(values) == 0:
+            return {"count": 0, "mean": None, "min": None, "max": None,
+                    "p50": None, "p90": None}
+        if numpy is not None:
+            return {"count": int(len(values)),
+                    "mean": float(values.mean()),
+                    "min": int(values.min()),
+                    "max": int(values.max()),
+                    "p50": float(numpy.percentile(values, 50)),
+                    "p90": float(numpy.percentile(values, 90))}
+        values = sorted(values)
+        return {"count": len(values),
+                "mean": sum(values) / len(values),
+                "min": values[0],
+                "max": values[-1],
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90)}
+
+    def mean_delay_by(self, key, train=None, station=None, start=None,
+                      end=None, kind=None):
+        '''Ritardo medio in secondi per ogni valore di key ("train",
+        "station" o "date"), come dizionario valore -> (osservazioni,
+        media)
+        '''
+        if key not in self.INDEXED:
+            raise ValueError("key must be one of {}".format(
+                ", ".join(self.INDEXED)))
+        selected = self._select(train, station, start, end, kind)
+        keys, values = selected[key], selected["delay"]
+        if numpy is not None:
+            unique, inverse = numpy.unique(keys, return_inverse=True)
+            counts = numpy.bincount(inverse)
+            sums = numpy.bincount(inverse, weights=values)
+            return {int(k): (int(n), float(s / n))
+                    for k, n, s in zip(unique, counts, sums)}
+        groups = {}
+        for k, v in zip(keys, values):
+            n, s = groups.get(k, (0, 0))
+            groups[k] = (n + 1, s + v)
+        return {k: (n, s / n) for k, (n, s) in sorted(groups.items())}
+
+
+def _json_default(obj):
+    '''Serializzazione JSON dei tipi usati nei risultati'''
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return int(obj.total_seconds())
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, _Record):
+        return obj.to_dict()
+    if isinstance(obj, LazyStops):
+        return list(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(
+        type(obj).__name__))
+
+
+def _dumps(obj):
+    return json.dumps(obj, default=_json_default, ensure_ascii=False,
+                      separators=(",", ":"))
+
+
+def _parse_arg_date(string):
+    return None if string is None else datetime.fromisoformat(string)
+
+
+def _run_query(tb, query):
+    '''Esegue una query della modalità batch: un dizionario con la chiave
+    "op" (stations, solutions, train o board) e gli argomenti del metodo
+    corrispondente
+    '''
+    args = dict(query)
+    op = args.pop("op", None)
+    args.pop("id", None)
+    for key in ("dep_date", "arr_date"):
+        if key in args:
+            args[key] = _parse_arg_date(args[key])
+    if op == "stations":
+        return tb.search_station(**args)
+    if op == "solutions":
+        args.setdefault("dep_date", None)
+        try:
+            return list(tb.search_solution(**args))
+        except tb.NoSolutionsFound:
+            return []
+    if op == "train":
+        return tb.train_info(**args)
+    if op == "board":
+        return tb.timetable(**args)
+    raise ValueError("Unknown op: {!r}".format(op))
+
+
+def _batch(tb, lines, out, workers, stats):
+    '''Esegue le query NDJSON lette da lines su al massimo workers thread
+    e scrive i risultati su out man mano che vengono completati. Le righe
+    vengono lette solo quando c'è posto in coda, quindi la memoria
+    occupata non dipende dal numero di query.
+    '''
+    tb._resize_pool(workers)
+
+    def run(item):
+        n, line = item
+        start = time.perf_counter()
+        output = {"line": n}
+        try:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                raise ValueError("Query must be a JSON object")
+            # L'id viene riportato anche se la query fallisce
+            output["id"] = query.get("id")
+            output["result"] = _run_query(tb, query)
+        except Exception as e:
+            output["error"] = "{}: {}".format(type(e).__name__, e)
+        return ("error" in output, _dumps(output),
+                time.perf_counter() - start)
+
+    items = ((n, line) for n, line in enumerate(lines, 1) if line.strip())
+    count = errors = 0
+    # Campione casuale di dimensione fissa delle latenze, per calcolare
+    # i percentili senza conservarle tutte
+    sample = []
+    start = time.perf_counter()
+    for _, (error, output, latency) in _imap_unordered(run, items,
+                                                        workers):
+        out.write(output + "\n")
+        out.flush()
+        count += 1
+        errors += error
+        if len(sample) < _LATENCY_SAMPLE:
+            sample.append(latency)
+        else:
+            i = random.randrange(count)
+            if i < _LATENCY_SAMPLE:
+                sample[i] = latency
+    elapsed = time.perf_counter() - start
+    if stats is not None:
+        summary = {"queries": count, "errors": errors,
+                   "seconds": round(elapsed, 3),
+                   "per_second": round(count / elapsed, 1) if elapsed else 0}
+        sample.sort()
+        for p in (50, 90, 99):
+            summary["p{}_ms".format(p)] = (
+                round(_percentile(sample, p) * 1000, 2) if sample else None)
+        stats.write(_dumps(summary) + "\n")
+
+
+def main(argv=None, backend=None):
+    '''Interfaccia a riga di comando (python -m trenitalia). I risultati
+    vengono scritti su stdout in formato NDJSON, un oggetto per riga.
+    '''
+    parser = argparse.ArgumentParser(
+        prog="python -m trenitalia",
+        description="Interroga il backend dell'app Trenitalia.")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="richieste contemporanee in modalità batch")
+    parser.add_argument("--stats", action="store_true",
+                        help="scrive su stderr un riepilogo di throughput "
+                             "e latenza (modalità batch)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("stations", help="ricerca delle stazioni")
+    p.add_argument("name")
+    p.add_argument("--only-italian", action="store_true")
+    p = commands.add_parser("solutions", help="soluzioni di viaggio")
+    p.add_argument("origin")
+    p.add_argument("destination")
+    p.add_argument("--dep-date", help="data e ora di partenza (ISO 8601)")
+    p.add_argument("--arr-date", help="data e ora di arrivo (ISO 8601)")
+    p.add_argument("--adults", type=int, default=1)
+    p.add_argument("--children", type=int, default=0)
+    p.add_argument("--train-type", default="All")
+    p.add_argument("--max-changes", type=int, default=99)
+    p.add_argument("--limit", type=int, default=10)
+    p = commands.add_parser("train", help="info su un treno")
+    p.add_argument("number")
+    p.add_argument("--dep-st")
+    p.add_argument("--arr-st")
+    p.add_argument("--dep-date", help="data di partenza (ISO 8601)")
+    p = commands.add_parser("board", help="tabellone di una stazione")
+    p.add_argument("station_id")
+    p.add_argument("--arrivals", action="store_true")
+    commands.add_parser("batch", help="legge query NDJSON da stdin")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be a positive integer")
+
+    tb = backend or TrenitaliaBackend(pool_size=args.workers, lazy=True)
+    out = sys.stdout
+    try:
+        if args.command == "batch":
+            _batch(tb, sys.stdin, out, args.workers,
+                   sys.stderr if args.stats else None)
+            return 0
+        if args.command == "stations":
+            results = tb.search_station(args.name, args.only_italian)
+        elif args.command == "solutions":
+            dep_date = _parse_arg_date(args.dep_date)
+            arr_date = _parse_arg_date(args.arr_date)
+            if dep_date is None and arr_date is None:
+                dep_date = datetime.now()
+            results = tb.search_solution(
+                args.origin, args.destination, dep_date, arr_date,
+                args.adults, args.children, args.train_type,
+                args.max_changes, args.limit)
+        elif args.command == "train":
+            results = [tb.train_info(args.number, args.dep_st, args.arr_st,
+                                     _parse_arg_date(args.dep_date))]
+        else:
+            results = tb.timetable(
+                args.station_id, "arrival" if args.arrivals else "departure")
+        for result in results:
+            out.write(_dumps(result) + "\n")
+            out.flush()
+    except (_TrenitaliaBase.TrainNotFound, _TrenitaliaBase.TrainCancelled,
+            _TrenitaliaBase.MultipleTrainsFound,
+            _TrenitaliaBase.NoSolutionsFound) as e:
+        sys.stderr.write("{}\n".format(type(e).__name__))
+        return 1
+    except BrokenPipeError:
+        # L'output è stato chiuso (ad esempio da head): non è un errore.
+        # Redirigo stdout su devnull perché Python non segnali un altro
+        # errore svuotandolo all'uscita
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    finally:
+        # Il backend passato dal chiamante resta aperto
+        if backend is None:
+            tb.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())